@@ -9,9 +9,27 @@ from phases.modeling import ModelingPhase
 from phases.ensemble import EnsemblePhase
 
 from pathlib import Path
+from concurrent.futures import ThreadPoolExecutor
 from dataclasses import dataclass
 from typing import Optional
 import json
+import re
+import threading
+
+
+# GGUFファイル名末尾の量子化タグ（例: -Q4_K_M.gguf, -IQ3_XS.gguf）
+_QUANT_TAG = re.compile(r"-(I?Q\d\w*)(?=\.gguf$)")
+
+
+def resolve_quantized_path(model_path: str, quant: Optional[str]) -> str:
+    """モデルパスの量子化タグをquantに置き換える（quantがNoneならそのまま）"""
+    if quant is None:
+        return model_path
+    path = Path(model_path)
+    name, count = _QUANT_TAG.subn(f"-{quant}", path.name)
+    if count == 0:
+        raise ValueError(f"Cannot find a quantization tag in {path.name}")
+    return str(path.with_name(name))
 
 
 @dataclass
@@ -21,8 +39,10 @@ class AgentConfig:
     competition_name: Optional[str] = None  # Kaggle competition name (e.g., 'titanic')
     text_model_path: str = "models/Llama-3.2-3B-Instruct-Q4_K_M.gguf"
     code_model_path: str = "models/Qwen3-Coder-30B-A3B-Instruct-Q4_K_M.gguf"
+    code_model_quant: Optional[str] = None  # e.g. 'IQ3_XS', 'Q3_K_S' (replaces the tag in code_model_path)
     max_improvement_iterations: int = 10
     target_score: Optional[float] = None
+    code_temperature: float = 0.3  # 0 makes code generation deterministic and enables the LLM cache
 
 
 class KaggleTabularAgent:
@@ -32,13 +52,17 @@ class KaggleTabularAgent:
         self.config = config
         self.competition_dir = Path(config.competition_dir)
         
-        # Core components
+        # Core components（実行ワーカーのimportをLLMのロードと並行させるため先に起動）
+        self.executor = CodeExecutor(working_dir=self.competition_dir)
         self.llm = LLMManager(
             text_model_path=config.text_model_path,
-            code_model_path=config.code_model_path
+            code_model_path=resolve_quantized_path(config.code_model_path, config.code_model_quant),
+            code_temperature=config.code_temperature
+        )
+        self.memory = AgentMemory(
+            history_dir=self.competition_dir / "history",
+            api_cache_path=self.competition_dir / "api_cache.json"
         )
-        self.executor = CodeExecutor(working_dir=self.competition_dir)
-        self.memory = AgentMemory()
         
         # Phase modules
         self.understanding = UnderstandingPhase(self.llm, self.memory)
@@ -74,31 +98,48 @@ class KaggleTabularAgent:
         print("\n[Phase 3/5] Creating Baseline...")
         baseline_result = self.modeling.create_baseline(eda_insights)
         best_score = baseline_result.get("cv_score", 0)
+        self.memory.update_best_score(best_score)
         print(f"  - Baseline CV Score: {best_score:.5f}")
         
         # 4. 改善ループ
+        # LLM（コード生成）とサブプロセス（学習）の2段パイプライン:
+        # イテレーションiの学習中に、i+1の特徴量コードを先行生成する
         print("\n[Phase 4/5] Improvement Loop...")
-        for i in range(self.config.max_improvement_iterations):
-            print(f"\n  Iteration {i+1}/{self.config.max_improvement_iterations}")
-            
-            # 特徴量エンジニアリング
-            fe_result = self.feature_engineering.run(eda_insights, self.memory.get_history())
-            
-            # モデル改善
-            model_result = self.modeling.improve(fe_result)
-            new_score = model_result.get("cv_score", 0)
-            
-            if new_score > best_score:
-                improvement = new_score - best_score
-                print(f"    ✓ Improved: {best_score:.5f} -> {new_score:.5f} (+{improvement:.5f})")
-                best_score = new_score
-                self.memory.update_best_score(best_score)
-            else:
-                print(f"    ✗ No improvement: {new_score:.5f}")
-            
-            if self.config.target_score and best_score >= self.config.target_score:
-                print(f"\n  🎯 Target score reached!")
-                break
+        max_iterations = self.config.max_improvement_iterations
+        i = 0
+        stop_prefetch = threading.Event()
+        pool = ThreadPoolExecutor(max_workers=2)
+        try:
+            if max_iterations > 0:
+                fe_future = pool.submit(self.feature_engineering.generate, eda_insights, stop_prefetch)
+            for i in range(max_iterations):
+                print(f"\n  Iteration {i+1}/{max_iterations}")
+                
+                # 特徴量エンジニアリング（コードは先行生成済み）
+                fe_result = self.feature_engineering.run(eda_insights, generated=fe_future.result())
+                
+                # モデル改善（学習中に次の特徴量コードを生成）
+                model_future = pool.submit(self.modeling.improve, fe_result)
+                if i + 1 < max_iterations:
+                    fe_future = pool.submit(self.feature_engineering.generate, eda_insights, stop_prefetch)
+                model_result = model_future.result()
+                new_score = model_result.get("cv_score", 0)
+                
+                if new_score > best_score:
+                    improvement = new_score - best_score
+                    print(f"    ✓ Improved: {best_score:.5f} -> {new_score:.5f} (+{improvement:.5f})")
+                    best_score = new_score
+                    self.memory.update_best_score(best_score)
+                else:
+                    print(f"    ✗ No improvement: {new_score:.5f}")
+                
+                if self.config.target_score and best_score >= self.config.target_score:
+                    print(f"\n  🎯 Target score reached!")
+                    break
+        finally:
+            # 目標達成で抜けた場合、使われない先行生成を待たない（未開始のLLM呼び出しも中止）
+            stop_prefetch.set()
+            pool.shutdown(wait=False, cancel_futures=True)
         
         # 5. アンサンブル
         print("\n[Phase 5/5] Ensemble...")
@@ -109,11 +150,13 @@ class KaggleTabularAgent:
         result = {
             "final_score": final_score,
             "iterations": i + 1,
-            "experiments": len(self.memory.experiments)
+            "experiments": len(self.memory.experiments),
+            "llm_cache": dict(self.llm.stats)
         }
         
         print("\n" + "=" * 60)
         print(f"Agent Completed! Final Score: {final_score:.5f}")
+        print(f"LLM cache: {self.llm.stats['cache_hits']} hits / {self.llm.stats['cache_misses']} misses")
         print("=" * 60)
         
         return result
@@ -127,8 +170,10 @@ def main():
     parser.add_argument("--competition-name", default=None, help="Kaggle competition name (e.g., 'titanic')")
     parser.add_argument("--text-model", default="models/Llama-3.2-3B-Instruct-Q4_K_M.gguf")
     parser.add_argument("--code-model", default="models/Qwen3-Coder-30B-A3B-Q4_K_M.gguf")
+    parser.add_argument("--code-model-quant", default=None, help="Quantization of the code model (e.g., 'IQ3_XS')")
     parser.add_argument("--max-iterations", type=int, default=10)
     parser.add_argument("--target-score", type=float, default=None)
+    parser.add_argument("--code-temperature", type=float, default=0.3, help="Sampling temperature for code generation (0 enables the LLM cache)")
     
     args = parser.parse_args()
     
@@ -137,8 +182,10 @@ def main():
         competition_name=args.competition_name,
         text_model_path=args.text_model,
         code_model_path=args.code_model,
+        code_model_quant=args.code_model_quant,
         max_improvement_iterations=args.max_iterations,
-        target_score=args.target_score
+        target_score=args.target_score,
+        code_temperature=args.code_temperature
     )
     
     agent = KaggleTabularAgent(config)
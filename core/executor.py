@@ -1,12 +1,61 @@
 """Code Executor - LLMが生成したPythonコードを安全に実行"""
 
 import subprocess
+import threading
 import os
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from dataclasses import dataclass
 from typing import Optional
 import traceback
 
+import httpx
+
+from .worker import CPU_AFFINITY_ENV, send_message, recv_message
+
+
+WORKER_PATH = Path(__file__).with_name("worker.py")
+
+# 修正依頼に含めるstderrの末尾行数（リトライのたびに会話が伸びてn_ctxを超えないように）
+ERROR_TAIL_LINES = 40
+
+
+def _tail(text: str, max_lines: int = ERROR_TAIL_LINES) -> str:
+    """末尾max_lines行だけを返す"""
+    lines = text.splitlines()
+    if len(lines) <= max_lines:
+        return text
+    return "\n".join(["...", *lines[-max_lines:]])
+
+
+def _set_process_affinity(pid: int, cpus) -> None:
+    """プロセスの全スレッドを指定CPUに固定（以後に作られるスレッドも引き継ぐ。非対応環境では何もしない）"""
+    if not hasattr(os, "sched_setaffinity"):
+        return
+    try:
+        tids = [int(tid) for tid in os.listdir(f"/proc/{pid}/task")]
+    except OSError:
+        tids = [pid]
+    for tid in tids:
+        try:
+            os.sched_setaffinity(tid, cpus)
+        except OSError:
+            pass
+
+
+def _visible_gpus() -> list[str]:
+    """利用可能なGPUのID一覧（CUDA_VISIBLE_DEVICES優先、なければnvidia-smi）"""
+    visible = os.environ.get("CUDA_VISIBLE_DEVICES")
+    if visible is not None:
+        return [g.strip() for g in visible.split(",") if g.strip()]
+    try:
+        output = subprocess.run(
+            ["nvidia-smi", "-L"], capture_output=True, text=True, timeout=10
+        ).stdout
+    except (OSError, subprocess.TimeoutExpired):
+        return []
+    return [str(i) for i, line in enumerate(output.splitlines()) if line.startswith("GPU ")]
+
 
 @dataclass
 class ExecutionResult:
@@ -14,51 +63,265 @@ class ExecutionResult:
     success: bool
     stdout: str
     stderr: str
-    return_value: Optional[str] = None
+    return_value: Optional[dict] = None
     error_type: Optional[str] = None
     error_message: Optional[str] = None
 
 
+class _WorkerProcess:
+    """常駐ワーカープロセス（core/worker.py）とのパイプ通信"""
+    
+    def __init__(self, python_path: str, working_dir: Path, env: dict):
+        self.process = subprocess.Popen(
+            [python_path, str(WORKER_PATH)],
+            cwd=str(working_dir),
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            env=env
+        )
+        # 起動完了（重いライブラリのimport完了）の通知は最初のリクエスト時に受け取る。
+        # ここで待たないことで、呼び出し側はimport中に他の初期化（LLMサーバーの起動など）を進められる
+        self._ready = False
+        # 生成コードから fast_ops が使えるか（起動完了の通知で分かる）
+        self.fast_ops = False
+    
+    @property
+    def ready(self) -> bool:
+        return self._ready
+    
+    def is_alive(self) -> bool:
+        return self.process.poll() is None
+    
+    def request(self, message: dict, timeout: float) -> tuple[Optional[dict], bool]:
+        """メッセージを送って応答を待つ。(応答, タイムアウトしたか) を返す
+        
+        タイムアウト時はウォッチドッグがワーカーをSIGKILLし、応答はNoneになる。
+        """
+        timed_out = threading.Event()
+        
+        def _on_timeout():
+            timed_out.set()
+            self.kill()
+        
+        watchdog = threading.Timer(timeout, _on_timeout)
+        watchdog.daemon = True
+        watchdog.start()
+        try:
+            if not self._ready:
+                ready = recv_message(self.process.stdout)
+                if ready is None:
+                    raise OSError("Executor worker failed to start")
+                self.fast_ops = ready.get("fast_ops", False)
+                self._ready = True
+            send_message(self.process.stdin, message)
+            response = recv_message(self.process.stdout)
+        except OSError:
+            response = None
+        finally:
+            watchdog.cancel()
+        return response, timed_out.is_set()
+    
+    def kill(self):
+        if self.is_alive():
+            self.process.kill()
+        self.process.wait()
+    
+    def shutdown(self):
+        """stdinを閉じてワーカーのループを終了させる"""
+        try:
+            self.process.stdin.close()
+            self.process.wait(timeout=10)
+        except (OSError, subprocess.TimeoutExpired):
+            self.kill()
+
+
 class CodeExecutor:
-    """Pythonコードを安全に実行するクラス"""
+    """Pythonコードを安全に実行するクラス
+    
+    pandas / sklearn / GBDT系ライブラリをimport済みのワーカープロセスを常駐させ、
+    コードを毎回新しいglobalsで実行する。タイムアウトやクラッシュ時はワーカーを再起動する。
+    """
     
     def __init__(
         self,
         working_dir: Path,
         timeout: int = 300,
-        python_path: str = "python"
+        python_path: str = "python",
+        max_output_lines: int = 512
     ):
         self.working_dir = Path(working_dir)
         self.timeout = timeout
         self.python_path = python_path
+        self.max_output_lines = max_output_lines
         self.working_dir.mkdir(parents=True, exist_ok=True)
+        
+        # ワーカー起動のたびに環境変数をコピーしないよう一度だけ作る
+        self._child_env = {**os.environ, "PYTHONUNBUFFERED": "1"}
+        self._lock = threading.Lock()
+        self._dataset: Optional[dict] = None
+        self._worker: Optional[_WorkerProcess] = self._spawn_worker()
+    
+    def _spawn_worker(self, extra_env: Optional[dict] = None) -> _WorkerProcess:
+        env = {**self._child_env, **extra_env} if extra_env else self._child_env
+        worker = _WorkerProcess(self.python_path, self.working_dir, env=env)
+        # 再起動時もデータセットを読み込み直す
+        if self._dataset is not None:
+            worker.request({"op": "load_dataset", "dataset": self._dataset}, timeout=self.timeout)
+        return worker
+    
+    def _request(self, message: dict) -> tuple[Optional[dict], bool]:
+        """ワーカーにリクエストを送る（ワーカー上では逐次実行）"""
+        with self._lock:
+            if self._worker is None or not self._worker.is_alive():
+                self._worker = self._spawn_worker()
+            response, timed_out = self._worker.request(message, timeout=self.timeout)
+            if response is None:
+                # 次回のリクエスト時に再起動する
+                self._worker.kill()
+                self._worker = None
+        return response, timed_out
+    
+    @property
+    def dataset_loaded(self) -> bool:
+        """train_df / test_df / folds がワーカーのglobalsとして使えるか"""
+        return self._dataset is not None
+    
+    @property
+    def fast_ops_loaded(self) -> bool:
+        """ワーカーが core/fast_ops.py を読み込めたか（起動完了を待って確認する）"""
+        worker = self._worker
+        if worker is None or not worker.ready:
+            self._request({"op": "ping"})
+            worker = self._worker
+        return worker is not None and worker.fast_ops
+    
+    def load_dataset(self, context: dict) -> ExecutionResult:
+        """ワーカーにtrain/testを読み込ませ、以後のコードから train_df / test_df / folds として使えるようにする"""
+        if not context.get("train_path"):
+            return ExecutionResult(
+                success=False,
+                stdout="",
+                stderr="No train_path in competition context",
+                error_type="ValueError",
+                error_message="No train_path in competition context"
+            )
+        
+        dataset = {
+            "train_path": context["train_path"],
+            "test_path": context.get("test_path"),
+            "target_column": context.get("target_column"),
+            "task_type": context.get("task_type", "unknown"),
+        }
+        response, timed_out = self._request({"op": "load_dataset", "dataset": dataset})
+        if response is not None and response["success"]:
+            self._dataset = dataset
+        
+        if response is None:
+            return ExecutionResult(
+                success=False,
+                stdout="",
+                stderr="Dataset loading timed out" if timed_out else "Executor worker exited unexpectedly",
+                error_type="TimeoutError" if timed_out else "WorkerCrashed",
+                error_message="Failed to load dataset into the executor worker"
+            )
+        return ExecutionResult(**response)
+    
+    def _script_path(self) -> Path:
+        """スレッドごとに別のスクリプトファイルを割り当てる（並行実行時の上書き防止）"""
+        thread = threading.current_thread()
+        if thread is threading.main_thread():
+            return self.working_dir / "_agent_script.py"
+        return self.working_dir / f"_agent_script_{thread.name}.py"
     
     def execute(self, code: str, save_script: bool = True) -> ExecutionResult:
-        """コードを実行"""
-        script_path = self.working_dir / "_agent_script.py"
+        """コードを実行（複数スレッドから呼び出し可能、ワーカー上では逐次実行）
+        
+        save_script=True の場合、デバッグ用にスクリプトをファイルにも保存する。
+        """
+        script_path = self._script_path()
         
         try:
-            with open(script_path, "w", encoding="utf-8") as f:
-                f.write(code)
+            if save_script:
+                with open(script_path, "w", encoding="utf-8") as f:
+                    f.write(code)
             
-            result = subprocess.run(
-                [self.python_path, str(script_path)],
-                cwd=str(self.working_dir),
-                capture_output=True,
-                text=True,
-                timeout=self.timeout,
-                env={**os.environ, "PYTHONUNBUFFERED": "1"}
-            )
+            response, timed_out = self._request(self._exec_message(code, script_path))
+            return self._to_result(response, timed_out)
             
-            return ExecutionResult(
-                success=result.returncode == 0,
-                stdout=result.stdout,
-                stderr=result.stderr,
-                error_type="RuntimeError" if result.returncode != 0 else None,
-                error_message=result.stderr if result.returncode != 0 else None
-            )
+        except Exception as e:
+            return self._exception_result(e)
+    
+    def execute_parallel(
+        self,
+        codes: dict[str, str],
+        reserve_main: bool = False
+    ) -> dict[str, ExecutionResult]:
+        """複数のコードを専用のワーカープロセスで同時に実行
+        
+        各ワーカーには重ならないCPU集合（とGPUがあればCUDA_VISIBLE_DEVICES）を割り当てる。
+        ワーカーは実行ごとに起動・終了し、読み込み済みのデータセットも再ロードする。
+        reserve_main=True の場合は、同時にメインワーカーで実行するコード用にCPU集合を1つ確保し、
+        実行が終わるまでメインワーカーをそのCPUに固定する。
+        """
+        names = list(codes)
+        if not names:
+            return {}
+        
+        cpus = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else []
+        gpus = _visible_gpus()
+        offset = 1 if reserve_main else 0
+        chunk = max(1, len(cpus) // (len(names) + offset))
+        
+        main_worker = self._worker if reserve_main else None
+        if main_worker is not None and cpus:
+            _set_process_affinity(main_worker.process.pid, cpus[:chunk])
+        
+        def _run(index: int, name: str) -> ExecutionResult:
+            extra_env = {}
+            slot = index + offset
+            cpu_slice = cpus[slot * chunk:(slot + 1) * chunk] or cpus
+            if cpu_slice:
+                extra_env[CPU_AFFINITY_ENV] = ",".join(map(str, cpu_slice))
+                extra_env["OMP_NUM_THREADS"] = str(len(cpu_slice))
+            if gpus:
+                extra_env["CUDA_VISIBLE_DEVICES"] = gpus[slot % len(gpus)]
             
-        except subprocess.TimeoutExpired:
+            script_path = self.working_dir / f"_agent_script_{name}.py"
+            try:
+                with open(script_path, "w", encoding="utf-8") as f:
+                    f.write(codes[name])
+                worker = self._spawn_worker(extra_env)
+            except Exception as e:
+                return self._exception_result(e)
+            
+            try:
+                response, timed_out = worker.request(
+                    self._exec_message(codes[name], script_path), timeout=self.timeout
+                )
+            finally:
+                worker.shutdown()
+            return self._to_result(response, timed_out)
+        
+        try:
+            with ThreadPoolExecutor(max_workers=len(names)) as pool:
+                futures = {name: pool.submit(_run, i, name) for i, name in enumerate(names)}
+                return {name: future.result() for name, future in futures.items()}
+        finally:
+            # 並列実行が終わったらメインワーカーに全CPUを戻す
+            if main_worker is not None and cpus and main_worker.is_alive():
+                _set_process_affinity(main_worker.process.pid, cpus)
+    
+    def _exec_message(self, code: str, script_path: Path) -> dict:
+        return {
+            "op": "exec",
+            "code": code,
+            "filename": str(script_path),
+            "max_output_lines": self.max_output_lines
+        }
+    
+    def _to_result(self, response: Optional[dict], timed_out: bool) -> ExecutionResult:
+        """ワーカーの応答をExecutionResultに変換"""
+        if timed_out:
             return ExecutionResult(
                 success=False,
                 stdout="",
@@ -66,35 +329,85 @@ class CodeExecutor:
                 error_type="TimeoutError",
                 error_message=f"Code execution exceeded {self.timeout}s limit"
             )
-        except Exception as e:
+        if response is None:
             return ExecutionResult(
                 success=False,
                 stdout="",
-                stderr=traceback.format_exc(),
-                error_type=type(e).__name__,
-                error_message=str(e)
+                stderr="Executor worker exited unexpectedly",
+                error_type="WorkerCrashed",
+                error_message="Executor worker exited unexpectedly (e.g. segfault or OOM)"
             )
-        finally:
-            if not save_script and script_path.exists():
-                script_path.unlink()
+        return ExecutionResult(**response)
+    
+    def _exception_result(self, e: Exception) -> ExecutionResult:
+        return ExecutionResult(
+            success=False,
+            stdout="",
+            stderr=traceback.format_exc(),
+            error_type=type(e).__name__,
+            error_message=str(e)
+        )
+    
+    def shutdown(self):
+        """ワーカープロセスを停止"""
+        with self._lock:
+            if self._worker is not None:
+                self._worker.shutdown()
+                self._worker = None
     
     def execute_with_retry(
         self,
         code: str,
         llm_manager,
-        max_retries: int = 3
+        max_retries: int = 3,
+        initial_result: Optional[ExecutionResult] = None
     ) -> ExecutionResult:
-        """エラー時にLLMで修正して再実行"""
+        """エラー時にLLMで修正して再実行
+        
+        コードを生成した会話が残っていれば、エラーだけを追記して修正を依頼する
+        （元のコードのトークンはKVキャッシュが再利用される）。
+        initial_result を渡すと、codeの1回目の実行を省略してその結果から始める。
+        """
         current_code = code
+        chat_id = llm_manager.open_code_chat(code)
         
-        for attempt in range(max_retries):
-            result = self.execute(current_code)
-            
-            if result.success:
-                return result
-            
-            if attempt < max_retries - 1:
-                fix_prompt = f"""The following Python code has an error. Please fix it.
+        try:
+            for attempt in range(max_retries):
+                if attempt == 0 and initial_result is not None:
+                    result = initial_result
+                else:
+                    result = self.execute(current_code)
+                
+                if result.success:
+                    return result
+                
+                # 失敗したコード（キャッシュされた修正コードも含む）は再利用しない
+                llm_manager.invalidate_code_cache(current_code)
+                
+                if attempt < max_retries - 1:
+                    error = f"{result.error_type}: {result.error_message}\n\n{_tail(result.stderr)}"
+                    print(f"  Retry {attempt + 1}: Attempting to fix error...")
+                    
+                    if chat_id is not None:
+                        try:
+                            current_code = llm_manager.generate_code_followup(
+                                chat_id,
+                                f"""The code above has an error. Please fix it.
+
+## Error:
+{error}
+
+Please provide the full corrected code only, without explanations."""
+                            )
+                            continue
+                        except (KeyError, httpx.HTTPError) as e:
+                            # 履歴が破棄された、または会話がn_ctxを超えた場合は新しい修正依頼に切り替える
+                            if isinstance(e, httpx.HTTPError):
+                                print(f"  Follow-up fix request failed ({e}), retrying with a fresh prompt")
+                            llm_manager.close_code_chat(chat_id)
+                            chat_id = None
+                    
+                    fix_prompt = f"""The following Python code has an error. Please fix it.
 
 ## Original Code:
 ```python
@@ -102,13 +415,18 @@ class CodeExecutor:
 ```
 
 ## Error:
-{result.error_type}: {result.error_message}
-
-{result.stderr}
+{error}
 
 Please provide the corrected code only, without explanations."""
-                
-                current_code = llm_manager.generate_code(fix_prompt)
-                print(f"  Retry {attempt + 1}: Attempting to fix error...")
-        
-        return result
+                    
+                    try:
+                        current_code = llm_manager.generate_code_cached(fix_prompt, cache_key="fix")
+                    except httpx.HTTPError as e:
+                        print(f"  Fix request failed: {e}")
+                        return result
+                    chat_id = llm_manager.open_code_chat(current_code)
+            
+            return result
+        finally:
+            if chat_id is not None:
+                llm_manager.close_code_chat(chat_id)
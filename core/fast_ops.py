@@ -0,0 +1,125 @@
+"""Fast Ops - 特徴量エンジニアリング用のNumba JITヘルパー
+
+実行ワーカーが起動時に `core.fast_ops` として読み込み、生成コードからは `fast_ops` として使える。
+keys は pd.factorize などで 0..n_groups-1 に符号化した整数配列を想定する（負値は欠損扱い）。
+"""
+
+from typing import Optional
+
+import numpy as np
+
+try:
+    from numba import njit
+except ImportError:
+    njit = None
+
+
+def _group_sums(keys, values, n_groups):
+    """グループごとの合計と件数（NaNと負のキーは無視）"""
+    sums = np.zeros(n_groups, dtype=np.float64)
+    counts = np.zeros(n_groups, dtype=np.float64)
+    for i in range(keys.shape[0]):
+        k = keys[i]
+        v = values[i]
+        if k >= 0 and v == v:
+            sums[k] += v
+            counts[k] += 1.0
+    return sums, counts
+
+
+def _key_counts(keys, n_groups):
+    """キーごとの出現回数（負のキーは無視）"""
+    counts = np.zeros(n_groups, dtype=np.float64)
+    for i in range(keys.shape[0]):
+        k = keys[i]
+        if k >= 0:
+            counts[k] += 1.0
+    return counts
+
+
+def _jit(signature: str, func):
+    """シグネチャを指定してimport時にコンパイル（cache=Trueで2回目以降はディスクから読み込む）"""
+    try:
+        return njit(signature, cache=True)(func)
+    except Exception:
+        # キャッシュはimport時のモジュール名を記録するため、別の名前で作られたものは読み込めない。
+        # その場合はキャッシュを使わずにコンパイルする
+        return njit(signature)(func)
+
+
+if njit is not None:
+    _group_sums = _jit("Tuple((float64[:], float64[:]))(int64[:], float64[:], int64)", _group_sums)
+    _key_counts = _jit("float64[:](int64[:], int64)", _key_counts)
+
+
+def _as_keys(keys, n_groups: int) -> np.ndarray:
+    """int64に変換し、JITループが範囲外に書き込まないようキーの上限を検証する"""
+    keys = np.ascontiguousarray(keys, dtype=np.int64)
+    if keys.ndim != 1:
+        raise ValueError(f"keys must be 1-dimensional, got shape {keys.shape}")
+    if keys.size and keys.max() >= n_groups:
+        raise ValueError(
+            f"keys must be < n_groups ({n_groups}), got max key {keys.max()}; "
+            "use n_groups = keys.max() + 1 after factorizing train and test together"
+        )
+    return keys
+
+
+def _as_values(values, keys: np.ndarray) -> np.ndarray:
+    values = np.ascontiguousarray(values, dtype=np.float64)
+    if values.shape != keys.shape:
+        raise ValueError(f"values shape {values.shape} does not match keys shape {keys.shape}")
+    return values
+
+
+def _lookup(table: np.ndarray, keys: np.ndarray, fill: float) -> np.ndarray:
+    """keysに対応するtableの値（負のキーはfill）"""
+    return np.where(keys >= 0, table[np.maximum(keys, 0)], fill)
+
+
+def groupby_mean(keys, values, n_groups: int) -> np.ndarray:
+    """グループごとの平均（長さn_groups、データのないグループはNaN）"""
+    keys = _as_keys(keys, n_groups)
+    sums, counts = _group_sums(keys, _as_values(values, keys), n_groups)
+    with np.errstate(invalid="ignore", divide="ignore"):
+        return sums / counts
+
+
+def count_encode(keys, n_groups: int) -> np.ndarray:
+    """各行のキーの出現回数（Count Encoding）"""
+    keys = _as_keys(keys, n_groups)
+    return _lookup(_key_counts(keys, n_groups), keys, 0.0)
+
+
+def target_encode_map(keys, values, n_groups: int, smoothing: float = 10.0) -> np.ndarray:
+    """グループごとの平滑化済みターゲット平均（長さn_groups）。test側は mapping[test_keys] で使う"""
+    keys = _as_keys(keys, n_groups)
+    values = _as_values(values, keys)
+    sums, counts = _group_sums(keys, values, n_groups)
+    prior = np.nanmean(values)
+    return (sums + prior * smoothing) / (counts + smoothing)
+
+
+def target_encode(
+    keys,
+    values,
+    n_groups: int,
+    smoothing: float = 10.0,
+    folds: Optional[list] = None,
+) -> np.ndarray:
+    """各行の平滑化済みターゲットエンコーディング
+
+    folds（(train_idx, valid_idx) のリスト）を渡すと、各validの行を
+    そのfoldのtrain部分だけから計算する（out-of-foldでリークを防ぐ）。
+    """
+    keys = _as_keys(keys, n_groups)
+    values = _as_values(values, keys)
+    if folds is None:
+        mapping = target_encode_map(keys, values, n_groups, smoothing)
+        return _lookup(mapping, keys, np.nanmean(values))
+
+    encoded = np.full(keys.shape[0], np.nan)
+    for train_idx, valid_idx in folds:
+        mapping = target_encode_map(keys[train_idx], values[train_idx], n_groups, smoothing)
+        encoded[valid_idx] = _lookup(mapping, keys[valid_idx], np.nanmean(values[train_idx]))
+    return encoded
@@ -1,139 +1,399 @@
-"""LLM Manager - 複数モデルを動的に切り替えて使用"""
+"""LLM Manager - 常駐させたllama.cppサーバー経由で複数モデルを使用"""
 
-from llama_cpp import Llama
+from collections import OrderedDict
 from pathlib import Path
 from typing import Optional
-import gc
+import atexit
+import hashlib
+import json
+import signal
+import subprocess
+import sys
+import threading
+import time
+
+import httpx
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+TEXT_SYSTEM_PROMPT = "You are a helpful assistant."
+CODE_SYSTEM_PROMPT = "You are an expert Python programmer. Generate clean, efficient code."
+CODE_GRAMMAR = Path(__file__).with_name("code.gbnf").read_text(encoding="utf-8")
+DEFAULT_CACHE_DIR = Path.home() / ".cache" / "kaggle-agent" / "code_cache"
+
+
+class LLMServerHandle:
+    """llama_cpp.server サブプロセスのハンドル"""
+
+    def __init__(
+        self,
+        model_path: Path,
+        port: int,
+        gpu_layers: int = -1,
+        tensor_split: Optional[list[float]] = None,
+        n_ctx: int = 8192,
+        n_batch: int = 512,
+        draft_tokens: Optional[int] = None,
+        host: str = "127.0.0.1",
+    ):
+        self.model_path = Path(model_path)
+        self.endpoint = f"http://{host}:{port}"
+
+        # --cache: プロンプトのKVキャッシュをRAMに保持し、共通プレフィックスのprefillを省略
+        cmd = [
+            sys.executable, "-m", "llama_cpp.server",
+            "--model", str(self.model_path),
+            "--host", host,
+            "--port", str(port),
+            "--n_ctx", str(n_ctx),
+            "--n_batch", str(n_batch),
+            "--n_gpu_layers", str(gpu_layers),
+            "--logits_all", "False",
+            "--cache", "True",
+            "--cache_type", "ram",
+        ]
+        if tensor_split:
+            cmd += ["--tensor_split", *[str(s) for s in tensor_split]]
+        if draft_tokens:
+            # 投機的デコーディング: プロンプト中のn-gramからdraft_tokens個を提案し、一括で検証
+            cmd += [
+                "--draft_model", "prompt-lookup-decoding",
+                "--draft_model_num_pred_tokens", str(draft_tokens),
+            ]
+
+        print(f"Starting LLM server: {self.model_path} ({self.endpoint})")
+        self.process = subprocess.Popen(cmd)
+
+    def wait_until_ready(self, client: httpx.Client, timeout: float = 600.0):
+        """モデルのロード完了（/v1/models が応答する）まで待機"""
+        deadline = time.monotonic() + timeout
+        while time.monotonic() < deadline:
+            if self.process.poll() is not None:
+                raise RuntimeError(
+                    f"LLM server for {self.model_path} exited with code {self.process.returncode}"
+                )
+            try:
+                if client.get(f"{self.endpoint}/v1/models").status_code == 200:
+                    return
+            except httpx.TransportError:
+                pass
+            time.sleep(1.0)
+        raise TimeoutError(f"LLM server for {self.model_path} did not start within {timeout}s")
+
+    def shutdown(self, timeout: float = 30.0):
+        """SIGTERMで停止し、応答がなければkill"""
+        if self.process.poll() is not None:
+            return
+        self.process.send_signal(signal.SIGTERM)
+        try:
+            self.process.wait(timeout=timeout)
+        except subprocess.TimeoutExpired:
+            self.process.kill()
+            self.process.wait()
+
+
+def _canonical_json(payload: dict) -> bytes:
+    """キー順を固定したコンパクトなJSON（orjsonの有無で同じバイト列になる）"""
+    if orjson is not None:
+        return orjson.dumps(payload, option=orjson.OPT_SORT_KEYS)
+    return json.dumps(
+        payload, sort_keys=True, separators=(",", ":"), ensure_ascii=False
+    ).encode("utf-8")
+
+
+def _code_sha(code: str) -> str:
+    return hashlib.sha256(code.encode("utf-8")).hexdigest()
+
+
+class LLMCache:
+    """決定的（temperature=0）なコード生成結果のディスクキャッシュ"""
+
+    def __init__(self, cache_dir: Path):
+        self.cache_dir = Path(cache_dir)
+        # 生成コードのsha256 -> キャッシュキー（実行に失敗したコードの無効化用）
+        self._keys: dict[str, str] = {}
+
+    @staticmethod
+    def make_key(model: str, prompt: str, temperature: float, **extra) -> str:
+        payload = {"model": model, "prompt": prompt, "temperature": temperature, **extra}
+        return hashlib.sha256(_canonical_json(payload)).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.py"
+
+    def get(self, key: str) -> Optional[str]:
+        path = self._path(key)
+        if not path.exists():
+            return None
+        code = path.read_text(encoding="utf-8")
+        self._keys[_code_sha(code)] = key
+        return code
+
+    def put(self, key: str, code: str):
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self._path(key).write_text(code, encoding="utf-8")
+        self._keys[_code_sha(code)] = key
+
+    def invalidate(self, code: str):
+        """codeを返したエントリを削除（このキャッシュ由来でなければ何もしない）"""
+        key = self._keys.pop(_code_sha(code), None)
+        if key is not None:
+            self._path(key).unlink(missing_ok=True)
 
 
 class LLMManager:
-    """LLMの管理と切り替えを行うクラス"""
-    
+    """LLMの管理を行うクラス（各モデルを別サーバーとして常駐）"""
+
     def __init__(
         self,
         text_model_path: str = "models/Llama-3.2-3B-Instruct-Q4_K_M.gguf",
         code_model_path: str = "models/Qwen3-Coder-30B-A3B-Q4_K_M.gguf",
         n_ctx: int = 8192,
         n_gpu_layers: int = -1,
+        text_port: int = 8081,
+        code_port: int = 8082,
+        text_tensor_split: Optional[list[float]] = None,
+        code_tensor_split: Optional[list[float]] = None,
+        code_draft_tokens: int = 8,
+        request_timeout: float = 600.0,
+        max_code_chats: int = 16,
+        cache_dir: Optional[Path] = DEFAULT_CACHE_DIR,
+        max_parallel_requests: int = 1,
+        code_temperature: float = 0.3,
     ):
         self.text_model_path = Path(text_model_path)
         self.code_model_path = Path(code_model_path)
         self.n_ctx = n_ctx
         self.n_gpu_layers = n_gpu_layers
-        
-        self._text_model: Optional[Llama] = None
-        self._code_model: Optional[Llama] = None
-        self._current_model_type: Optional[str] = None
-    
-    def _load_text_model(self) -> Llama:
-        """テキスト理解用モデルをロード"""
-        if self._text_model is None:
-            if self._code_model is not None:
-                del self._code_model
-                self._code_model = None
-                gc.collect()
-            
-            print(f"Loading text model: {self.text_model_path}")
-            self._text_model = Llama(
-                model_path=str(self.text_model_path),
-                n_ctx=self.n_ctx,
-                n_gpu_layers=self.n_gpu_layers,
-                verbose=False
-            )
-            self._current_model_type = "text"
-        return self._text_model
-    
-    def _load_code_model(self) -> Llama:
-        """コード生成用モデルをロード"""
-        if self._code_model is None:
-            if self._text_model is not None:
-                del self._text_model
-                self._text_model = None
-                gc.collect()
-            
-            print(f"Loading code model: {self.code_model_path}")
-            self._code_model = Llama(
-                model_path=str(self.code_model_path),
-                n_ctx=self.n_ctx,
-                n_gpu_layers=self.n_gpu_layers,
-                verbose=False
-            )
-            self._current_model_type = "code"
-        return self._code_model
-    
+
+        # コード生成の会話履歴（chat_id -> messages）。リトライ時に続きから依頼してKVキャッシュを再利用する
+        self._chats: OrderedDict[str, list[dict]] = OrderedDict()
+        self._chats_lock = threading.Lock()
+        self.max_code_chats = max_code_chats
+
+        # 生成コードのディスクキャッシュ（temperature=0の生成のみ対象）。
+        # code_temperature はフェーズのコード生成の既定値で、0にすると生成が決定的になりキャッシュが効く
+        self.code_temperature = code_temperature
+        self.cache = LLMCache(cache_dir) if cache_dir is not None else None
+        self.stats = {"cache_hits": 0, "cache_misses": 0}
+
+        # keep-aliveで両サーバーへの接続を使い回す
+        self._client = httpx.Client(timeout=httpx.Timeout(request_timeout, connect=10.0))
+
+        # llama_cpp.serverは1スロットで逐次処理するため、サーバーごとの同時リクエスト数を制限する。
+        # 順番待ちをクライアント側で行うことで、待ち時間がrequest_timeoutに含まれないようにする
+        self.max_parallel_requests = max_parallel_requests
+        self._slots: dict[str, threading.BoundedSemaphore] = {}
+        self._slots_lock = threading.Lock()
+
+        # テキストモデルは任意のため、最初の generate_text 呼び出し時に起動する（使わなければVRAMを占有しない）
+        self._text_port = text_port
+        self._text_tensor_split = text_tensor_split
+        self._text_server: Optional[LLMServerHandle] = None
+        self._text_lock = threading.Lock()
+
+        # コードモデルは常駐させ、以後は再ロードしない
+        self._code_server = LLMServerHandle(
+            self.code_model_path, code_port, n_gpu_layers, code_tensor_split, n_ctx,
+            draft_tokens=code_draft_tokens
+        )
+        atexit.register(self.unload_all)
+
+        try:
+            self._code_server.wait_until_ready(self._client)
+        except Exception:
+            self.unload_all()
+            raise
+
+        self._code_endpoint: str = self._code_server.endpoint
+
+        # システムプロンプトを一度評価してKVキャッシュに載せておく
+        self._warmup(self._code_endpoint, CODE_SYSTEM_PROMPT)
+
+    def _text_endpoint(self) -> str:
+        """テキストモデルのサーバーを必要になった時点で起動し、そのエンドポイントを返す"""
+        with self._text_lock:
+            if self._text_server is None:
+                if not self.text_model_path.exists():
+                    raise FileNotFoundError(f"Text model not found: {self.text_model_path}")
+                server = LLMServerHandle(
+                    self.text_model_path, self._text_port, self.n_gpu_layers,
+                    self._text_tensor_split, self.n_ctx
+                )
+                try:
+                    server.wait_until_ready(self._client)
+                except Exception:
+                    server.shutdown()
+                    raise
+                self._text_server = server
+            return self._text_server.endpoint
+
+    def _warmup(self, endpoint: str, system_prompt: str):
+        """システムプロンプトのみで1トークン生成し、プレフィックスをキャッシュさせる"""
+        messages = [{"role": "system", "content": system_prompt}]
+        self._chat_completion(endpoint, messages, max_tokens=1, temperature=0.0)
+
+    def _chat_completion(
+        self,
+        endpoint: str,
+        messages: list[dict],
+        max_tokens: int,
+        temperature: float,
+        grammar: Optional[str] = None,
+    ) -> str:
+        """OpenAI互換の /v1/chat/completions を呼び出す"""
+        payload = {
+            "messages": messages,
+            "max_tokens": max_tokens,
+            "temperature": temperature,
+            "cache_prompt": True,
+        }
+        if grammar is not None:
+            payload["grammar"] = grammar
+        with self._slots_lock:
+            slot = self._slots.setdefault(endpoint, threading.BoundedSemaphore(self.max_parallel_requests))
+        with slot:
+            response = self._client.post(f"{endpoint}/v1/chat/completions", json=payload)
+        response.raise_for_status()
+        return response.json()["choices"][0]["message"]["content"]
+
     def generate_text(
         self,
         prompt: str,
-        system_prompt: str = "You are a helpful assistant.",
+        system_prompt: str = TEXT_SYSTEM_PROMPT,
         max_tokens: int = 2048,
         temperature: float = 0.7,
     ) -> str:
-        """テキスト理解・生成（Llama-3.2-3B使用）"""
-        model = self._load_text_model()
-        
+        """テキスト理解・生成（Llama-3.2-3B使用、初回呼び出し時にサーバーを起動）"""
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": prompt}
         ]
-        
-        response = model.create_chat_completion(
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature,
-        )
-        
-        return response["choices"][0]["message"]["content"]
-    
+
+        return self._chat_completion(self._text_endpoint(), messages, max_tokens, temperature)
+
     def generate_code(
         self,
         prompt: str,
-        system_prompt: str = "You are an expert Python programmer. Generate clean, efficient code.",
+        system_prompt: str = CODE_SYSTEM_PROMPT,
         max_tokens: int = 4096,
         temperature: float = 0.3,
+        cache_key: Optional[str] = None,
+        prefix: Optional[str] = None,
     ) -> str:
-        """コード生成（Qwen3-Coder-30B使用）"""
-        model = self._load_code_model()
-        
+        """コード生成（Qwen3-Coder-30B使用）
+
+        cache_key（例: "eda"）を指定し temperature=0 の場合、同じプロンプトで
+        生成済みのコードをディスクから再利用する（temperature>0 はキャッシュしない）。
+        prefix には呼び出しごとに変わらない指示（役割・要件・出力形式）を渡す。
+        userメッセージの先頭に置くので、サーバー側でそのprefillがKVキャッシュから再利用される。
+        """
+        if prefix is not None:
+            prompt = f"{prefix}\n\n{prompt}"
         messages = [
             {"role": "system", "content": system_prompt},
             {"role": "user", "content": prompt}
         ]
-        
-        response = model.create_chat_completion(
-            messages=messages,
-            max_tokens=max_tokens,
-            temperature=temperature,
+
+        key = None
+        if cache_key is not None and self.cache is not None and temperature == 0:
+            key = LLMCache.make_key(
+                str(self.code_model_path), prompt, temperature,
+                system_prompt=system_prompt, namespace=cache_key,
+            )
+            code = self.cache.get(key)
+            if code is not None:
+                self.stats["cache_hits"] += 1
+                self._store_chat(code, messages + [
+                    {"role": "assistant", "content": f"```python\n{code}\n```"}
+                ])
+                return code
+            self.stats["cache_misses"] += 1
+
+        # GBNF文法で出力を ```python ... ``` の1ブロックに制約する
+        content = self._chat_completion(
+            self._code_endpoint, messages, max_tokens, temperature, grammar=CODE_GRAMMAR
         )
-        
-        content = response["choices"][0]["message"]["content"]
+        code = self._extract_code(content)
+        self._store_chat(code, messages + [{"role": "assistant", "content": content}])
+
+        if key is not None:
+            self.cache.put(key, code)
+        return code
+
+    def generate_code_cached(
+        self,
+        prompt: str,
+        system_prompt: str = CODE_SYSTEM_PROMPT,
+        max_tokens: int = 4096,
+        cache_key: str = "code",
+        prefix: Optional[str] = None,
+        temperature: Optional[float] = None,
+    ) -> str:
+        """キャッシュ対象としてコード生成（temperature省略時は code_temperature）
+
+        temperature=0 の場合のみ、同一プロンプトの結果をキャッシュから返す。
+        """
+        if temperature is None:
+            temperature = self.code_temperature
+        return self.generate_code(
+            prompt, system_prompt, max_tokens, temperature=temperature, cache_key=cache_key,
+            prefix=prefix
+        )
+
+    def invalidate_code_cache(self, code: str):
+        """実行に失敗したコードをキャッシュから削除"""
+        if self.cache is not None:
+            self.cache.invalidate(code)
+
+    def _store_chat(self, code: str, messages: list[dict]):
+        """生成したコードをキーに会話履歴を保持（古いものから破棄）"""
+        chat_id = _code_sha(code)
+        with self._chats_lock:
+            self._chats[chat_id] = messages
+            self._chats.move_to_end(chat_id)
+            while len(self._chats) > self.max_code_chats:
+                self._chats.popitem(last=False)
+
+    def open_code_chat(self, code: str) -> Optional[str]:
+        """codeを生成した会話のchat_idを返す（履歴がなければNone）"""
+        chat_id = _code_sha(code)
+        with self._chats_lock:
+            return chat_id if chat_id in self._chats else None
+
+    def close_code_chat(self, chat_id: str):
+        with self._chats_lock:
+            self._chats.pop(chat_id, None)
+
+    def generate_code_followup(
+        self,
+        chat_id: str,
+        user_msg: str,
+        max_tokens: int = 4096,
+        temperature: float = 0.3,
+    ) -> str:
+        """既存の会話に追記してコードを再生成（共通プレフィックスのprefillは省略される）"""
+        with self._chats_lock:
+            messages = self._chats[chat_id] + [{"role": "user", "content": user_msg}]
+
+        content = self._chat_completion(
+            self._code_endpoint, messages, max_tokens, temperature, grammar=CODE_GRAMMAR
+        )
+        with self._chats_lock:
+            self._chats[chat_id] = messages + [{"role": "assistant", "content": content}]
         return self._extract_code(content)
-    
+
     def _extract_code(self, content: str) -> str:
-        """レスポンスからPythonコードを抽出"""
-        if "```python" in content:
-            start = content.find("```python") + len("```python")
-            end = content.find("```", start)
-            if end != -1:
-                return content[start:end].strip()
-        
-        if "```" in content:
-            start = content.find("```") + 3
-            newline = content.find("\n", start)
-            if newline != -1:
-                start = newline + 1
-            end = content.find("```", start)
-            if end != -1:
-                return content[start:end].strip()
-        
-        return content.strip()
-    
+        """コードブロックのフェンスを除去（max_tokensで打ち切られた場合も考慮）"""
+        return content.removeprefix("```python").removesuffix("```").strip()
+
     def unload_all(self):
-        """全モデルをメモリから解放"""
-        if self._text_model is not None:
-            del self._text_model
-            self._text_model = None
-        if self._code_model is not None:
-            del self._code_model
-            self._code_model = None
-        gc.collect()
-        self._current_model_type = None
+        """全サーバーを停止してモデルを解放"""
+        for server in (self._text_server, self._code_server):
+            if server is not None:
+                server.shutdown()
+        self._client.close()
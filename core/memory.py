@@ -1,11 +1,41 @@
 """Agent Memory - 試行履歴とコンテキスト管理"""
 
+from collections import deque
 from dataclasses import dataclass, field
 from typing import Optional
 from datetime import datetime
+import hashlib
+import heapq
+import itertools
 import json
+import time
 from pathlib import Path
 
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+
+# Kaggle APIのレスポンスキャッシュの有効期限（秒）
+API_CACHE_TTL = 24 * 60 * 60
+
+
+def _dump_json(path: Path, data: dict):
+    if orjson is not None:
+        with open(path, "wb") as f:
+            f.write(orjson.dumps(data, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+    else:
+        with open(path, "w") as f:
+            json.dump(data, f, indent=2, ensure_ascii=False)
+
+
+def _load_json(path: Path) -> dict:
+    if orjson is not None:
+        return orjson.loads(path.read_bytes())
+    with open(path) as f:
+        return json.load(f)
+
 
 @dataclass
 class Experiment:
@@ -13,7 +43,8 @@ class Experiment:
     timestamp: str
     phase: str
     description: str
-    code: str
+    code_path: str
+    code_sha: str
     cv_score: Optional[float] = None
     lb_score: Optional[float] = None
     success: bool = True
@@ -21,11 +52,19 @@ class Experiment:
     features_used: list[str] = field(default_factory=list)
     model_type: Optional[str] = None
     
+    def load_code(self) -> str:
+        """保存したコードをディスクから読み込む"""
+        if not self.code_path:
+            return ""
+        return Path(self.code_path).read_text(encoding="utf-8")
+    
     def to_dict(self) -> dict:
         return {
             "timestamp": self.timestamp,
             "phase": self.phase,
             "description": self.description,
+            "code_path": self.code_path,
+            "code_sha": self.code_sha,
             "cv_score": self.cv_score,
             "lb_score": self.lb_score,
             "success": self.success,
@@ -48,14 +87,29 @@ class ModelRecord:
 class AgentMemory:
     """エージェントのメモリシステム"""
     
-    def __init__(self):
+    def __init__(self, history_dir: Optional[Path] = None, api_cache_path: Optional[Path] = None):
+        # 生成コードはメモリに保持せず、このディレクトリに保存する
+        self.history_dir = Path(history_dir) if history_dir is not None else None
         self.experiments: list[Experiment] = []
         self.competition_context: dict = {}
         self.best_score: float = 0.0
-        self.best_models: list[ModelRecord] = []
+        self.max_best_models: int = 5
+        # (cv_score, 挿入順, model) の最小ヒープ（上位max_best_models件のみ保持）
+        self._best_models_heap: list[tuple[float, int, ModelRecord]] = []
+        self._model_counter = itertools.count()
         self.eda_insights: dict = {}
-        self.feature_ideas: list[str] = []
+        # 挿入順を保つ集合として使う（値は常にNone）
+        self.feature_ideas: dict[str, None] = {}
         self.tried_features: set[str] = set()
+        # プロンプト用の履歴文字列のキャッシュ（作成時の試行数・ベストスコアと組で保持し、変化したら作り直す）
+        self._recent_descriptions: deque[str] = deque(maxlen=5)
+        self._history_summary_str: tuple[int, str] = (-1, "")
+        self._history_summary: tuple[tuple[int, float], str] = ((-1, 0.0), "")
+        # キー -> {"fetched_at": UNIX時刻, "data": レスポンス}（api_cache_pathがあれば実行をまたいで保持）
+        self.api_cache_path = Path(api_cache_path) if api_cache_path is not None else None
+        self.api_cache: dict[str, dict] = {}
+        if self.api_cache_path is not None and self.api_cache_path.exists():
+            self.api_cache = _load_json(self.api_cache_path)
     
     def set_competition_context(self, context: dict):
         self.competition_context = context
@@ -70,37 +124,66 @@ class AgentMemory:
         notes: str = "",
         model_type: Optional[str] = None
     ):
+        now = datetime.now()
+        code_path = ""
+        if self.history_dir is not None:
+            self.history_dir.mkdir(parents=True, exist_ok=True)
+            path = self.history_dir / f"{now.strftime('%Y%m%dT%H%M%S_%f')}_{phase}.py"
+            path.write_text(code, encoding="utf-8")
+            code_path = str(path)
+        
         exp = Experiment(
-            timestamp=datetime.now().isoformat(),
+            timestamp=now.isoformat(),
             phase=phase,
             description=description,
-            code=code,
+            code_path=code_path,
+            code_sha=hashlib.sha256(code.encode("utf-8")).hexdigest(),
             cv_score=cv_score,
             success=success,
             notes=notes,
             model_type=model_type
         )
+        self._recent_descriptions.append(description)
         self.experiments.append(exp)
-        
-        if cv_score and cv_score > self.best_score:
-            self.best_score = cv_score
     
     def update_best_score(self, score: float):
         if score > self.best_score:
             self.best_score = score
     
     def add_model(self, model: ModelRecord):
-        self.best_models.append(model)
-        self.best_models.sort(key=lambda m: m.cv_score, reverse=True)
-        self.best_models = self.best_models[:5]
+        entry = (model.cv_score, next(self._model_counter), model)
+        if len(self._best_models_heap) < self.max_best_models:
+            heapq.heappush(self._best_models_heap, entry)
+        else:
+            heapq.heappushpop(self._best_models_heap, entry)
     
     def get_best_models(self, top_k: int = 5) -> list[ModelRecord]:
-        return self.best_models[:top_k]
+        ranked = sorted(self._best_models_heap, reverse=True)
+        return [model for _, _, model in ranked[:top_k]]
     
     def get_history(self) -> list[dict]:
         return [exp.to_dict() for exp in self.experiments]
     
+    @property
+    def history_summary_str(self) -> str:
+        """直近5件の試行の説明（特徴量エンジニアリングのプロンプト用）"""
+        key = len(self.experiments)
+        cached_key, text = self._history_summary_str
+        if cached_key != key:
+            recent = list(self._recent_descriptions)
+            text = "\n".join(f"- {d}" for d in recent) if recent else "No previous experiments."
+            self._history_summary_str = (key, text)
+        return text
+    
     def get_history_summary(self) -> str:
+        key = (len(self.experiments), self.best_score)
+        cached_key, text = self._history_summary
+        if cached_key != key:
+            text = self._build_history_summary()
+            self._history_summary = (key, text)
+        return text
+    
+    def _build_history_summary(self) -> str:
         if not self.experiments:
             return "No experiments recorded yet."
         
@@ -120,15 +203,27 @@ class AgentMemory:
     
     def add_feature_idea(self, idea: str):
         if idea not in self.tried_features:
-            self.feature_ideas.append(idea)
+            self.feature_ideas.setdefault(idea, None)
     
     def mark_feature_tried(self, feature: str):
         self.tried_features.add(feature)
-        if feature in self.feature_ideas:
-            self.feature_ideas.remove(feature)
+        self.feature_ideas.pop(feature, None)
     
     def get_untried_features(self) -> list[str]:
-        return [f for f in self.feature_ideas if f not in self.tried_features]
+        return list(self.feature_ideas)
+    
+    def get_api_cache(self, key: str, ttl: float = API_CACHE_TTL) -> Optional[dict]:
+        """有効期限内のAPIレスポンスを返す（なければNone）"""
+        entry = self.api_cache.get(key)
+        if entry is None or time.time() - entry["fetched_at"] > ttl:
+            return None
+        return entry["data"]
+    
+    def set_api_cache(self, key: str, data: dict):
+        self.api_cache[key] = {"fetched_at": time.time(), "data": data}
+        if self.api_cache_path is not None:
+            self.api_cache_path.parent.mkdir(parents=True, exist_ok=True)
+            _dump_json(self.api_cache_path, self.api_cache)
     
     def save(self, path: Path):
         data = {
@@ -136,18 +231,18 @@ class AgentMemory:
             "best_score": self.best_score,
             "experiments": [exp.to_dict() for exp in self.experiments],
             "eda_insights": self.eda_insights,
-            "feature_ideas": self.feature_ideas,
-            "tried_features": list(self.tried_features)
+            "feature_ideas": list(self.feature_ideas),
+            "tried_features": list(self.tried_features),
+            "api_cache": self.api_cache
         }
-        with open(path, "w") as f:
-            json.dump(data, f, indent=2, ensure_ascii=False)
+        _dump_json(path, data)
     
     def load(self, path: Path):
         if path.exists():
-            with open(path) as f:
-                data = json.load(f)
+            data = _load_json(path)
             self.competition_context = data.get("competition_context", {})
             self.best_score = data.get("best_score", 0.0)
             self.eda_insights = data.get("eda_insights", {})
-            self.feature_ideas = data.get("feature_ideas", [])
+            self.feature_ideas = dict.fromkeys(data.get("feature_ideas", []))
             self.tried_features = set(data.get("tried_features", []))
+            self.api_cache = data.get("api_cache", {})
@@ -0,0 +1,386 @@
+"""Executor Worker - 重いライブラリを一度だけimportし、送られてきたコードを繰り返し実行
+
+CodeExecutorから `python core/worker.py` として起動される常駐プロセス。
+stdin/stdoutを長さ付きpickleフレームのプロトコルとして使う。
+"""
+
+import contextlib
+import gc
+import hashlib
+import importlib
+import io
+import json
+import linecache
+import os
+import pickle
+import struct
+import sys
+import traceback
+from collections import deque
+from typing import Optional
+
+try:
+    from orjson import loads as _orjson_loads
+except ImportError:
+    _orjson_loads = None
+
+
+_HEADER = struct.Struct("!I")
+CPU_AFFINITY_ENV = "KAGGLE_AGENT_CPUS"
+PRELOAD_MODULES = ("pandas", "numpy", "sklearn", "lightgbm", "xgboost", "catboost")
+
+# load_datasetで読み込んだデータ（train_df / test_df / folds）
+_session: dict = {}
+
+# パッチ前のpandas.read_csv
+_native_read_csv = None
+
+# pandasが常にCopy-on-Writeか（pandas 3以降。それなら読み込み済みDataFrameを浅いコピーで渡せる）
+_copy_on_write = False
+
+# リポジトリのルート（fast_opsを常に `core.fast_ops` としてimportするためsys.pathに追加する）
+_REPO_ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Numba JITヘルパー（core/fast_ops.py、読み込めなければNone）
+_fast_ops = None
+
+# 検証行のハッシュ -> (特徴量列, booster)。学習用Datasetを抱えたままになるので検証行ごとに直近の1つだけ保持する
+_warm_boosters: dict[str, tuple[tuple, object]] = {}
+
+
+def send_message(stream, message: dict):
+    """長さ付きpickleフレームを送信"""
+    data = pickle.dumps(message, protocol=pickle.HIGHEST_PROTOCOL)
+    stream.write(_HEADER.pack(len(data)))
+    stream.write(data)
+    stream.flush()
+
+
+def recv_message(stream) -> Optional[dict]:
+    """長さ付きpickleフレームを受信（EOFならNone）"""
+    header = stream.read(_HEADER.size)
+    if len(header) < _HEADER.size:
+        return None
+    (size,) = _HEADER.unpack(header)
+    data = stream.read(size)
+    if len(data) < size:
+        return None
+    return pickle.loads(data)
+
+
+def json_loads(text: str):
+    """orjsonで読み、失敗したらjson.loadsで読み直す（json.dumpsが既定で出力するNaN/Infinityをorjsonは受け付けない）"""
+    if _orjson_loads is not None:
+        try:
+            return _orjson_loads(text)
+        except ValueError:
+            pass
+    return json.loads(text)
+
+
+class OutputCollector(io.TextIOBase):
+    """末尾max_lines行だけを保持する出力先（JSON行は到着時にパース）"""
+
+    def __init__(self, max_lines: int = 512, parse_json: bool = False):
+        self.lines: deque[str] = deque(maxlen=max_lines)
+        self.parse_json = parse_json
+        self.last_json: Optional[dict] = None
+        self._partial = ""
+
+    def writable(self) -> bool:
+        return True
+
+    def write(self, text: str) -> int:
+        data = self._partial + text
+        *complete, self._partial = data.split("\n")
+        for line in complete:
+            self._add_line(line + "\n")
+        return len(text)
+
+    def _add_line(self, line: str):
+        self.lines.append(line)
+        if self.parse_json and line.lstrip().startswith("{"):
+            try:
+                value = json_loads(line)
+            except ValueError:
+                return
+            if isinstance(value, dict):
+                self.last_json = value
+
+    def getvalue(self) -> str:
+        if self._partial:
+            self._add_line(self._partial)
+            self._partial = ""
+        return "".join(self.lines)
+
+
+def _has_temporal_columns(path) -> bool:
+    """先頭ブロックから推論したスキーマに日付・時刻の列があるか"""
+    import pyarrow as pa
+    from pyarrow import csv as pa_csv
+    reader = pa_csv.open_csv(path)
+    try:
+        return any(pa.types.is_temporal(field.type) for field in reader.schema)
+    finally:
+        reader.close()
+
+
+def _fast_read_csv(path, *args, **kwargs):
+    """引数なしの読み込みはpyarrowのマルチスレッドCSVパーサで読む（それ以外や失敗時は通常のパーサ）
+
+    pyarrowは日付列を datetime.date / datetime64 に変換し、通常のパーサ（文字列のまま）とdtypeが変わるため、
+    日付・時刻の列があるファイルも通常のパーサで読む。
+    """
+    read_csv = _native_read_csv
+    if read_csv is None:
+        import pandas as pd
+        read_csv = pd.read_csv
+    if not args and not kwargs:
+        try:
+            if not _has_temporal_columns(path):
+                return read_csv(path, engine="pyarrow")
+        except (ImportError, ValueError, TypeError, NotImplementedError, OSError):
+            pass
+    return read_csv(path, *args, **kwargs)
+
+
+def _patched_read_csv(filepath_or_buffer, *args, **kwargs):
+    """train/testのパスなら読み込み済みのDataFrameのコピーを返し、それ以外は可能ならpyarrowで読む"""
+    if isinstance(filepath_or_buffer, (str, os.PathLike)) and "engine" not in kwargs:
+        if not args and not kwargs:
+            cached = _session.get("frames", {}).get(os.path.realpath(filepath_or_buffer))
+            if cached is not None:
+                return _session_copy(cached)
+        return _fast_read_csv(filepath_or_buffer, *args, **kwargs)
+    return _native_read_csv(filepath_or_buffer, *args, **kwargs)
+
+
+def _session_copy(df):
+    """スクリプトに渡すDataFrameのコピー（Copy-on-Writeなら変更時まで実データを共有する）"""
+    return df.copy(deep=not _copy_on_write)
+
+
+def _install_read_csv_patch():
+    """生成コードの pd.read_csv を _patched_read_csv に差し替える"""
+    global _native_read_csv, _copy_on_write
+    try:
+        import pandas as pd
+    except ImportError:
+        return
+    # pandas 3以降は常にCopy-on-Write。pandas 2ではオプションを有効にすると
+    # `df[col].fillna(v, inplace=True)` などの生成コードが無効になるため、従来どおり深いコピーを渡す
+    _copy_on_write = int(pd.__version__.split(".")[0]) >= 3
+    if _native_read_csv is None:
+        _native_read_csv = pd.read_csv
+        pd.read_csv = _patched_read_csv
+
+
+def _load_dataset(
+    train_path: str,
+    test_path: Optional[str] = None,
+    target_column: Optional[str] = None,
+    task_type: str = "unknown",
+    n_splits: int = 5,
+    seed: int = 42,
+) -> dict:
+    """train/testを一度だけ読み込み、CVのfoldも事前に計算しておく"""
+    import pandas as pd
+    from sklearn.model_selection import KFold, StratifiedKFold
+
+    train_df = _fast_read_csv(train_path)
+    test_df = _fast_read_csv(test_path) if test_path else None
+
+    if task_type == "classification" and target_column in train_df.columns:
+        splitter = StratifiedKFold(n_splits=n_splits, shuffle=True, random_state=seed)
+        folds = list(splitter.split(train_df, train_df[target_column]))
+    else:
+        splitter = KFold(n_splits=n_splits, shuffle=True, random_state=seed)
+        folds = list(splitter.split(train_df))
+
+    frames = {os.path.realpath(train_path): train_df}
+    if test_path:
+        frames[os.path.realpath(test_path)] = test_df
+
+    _session.clear()
+    _session.update(train_df=train_df, test_df=test_df, folds=folds, frames=frames)
+
+    return {
+        "success": True,
+        "stdout": f"Loaded {train_path}: {train_df.shape}, {len(folds)} folds\n",
+        "stderr": "",
+    }
+
+
+def _fold_hash(valid_idx) -> str:
+    """検証行の集合のハッシュ（同じ行を検証に使うfold同士でのみboosterを共有する）"""
+    import numpy as np
+    rows = np.unique(np.asarray(valid_idx, dtype=np.int64))
+    return hashlib.sha1(rows.tobytes()).hexdigest()
+
+
+def save_warm_booster(features, booster, valid_idx):
+    """学習済みboosterを特徴量列（順序込み）・検証行と紐付けて保存（次のイテレーションで継続学習に使う）"""
+    _warm_boosters[_fold_hash(valid_idx)] = (tuple(features), booster)
+
+
+def get_warm_booster(features, valid_idx):
+    """同じ検証行で直近に学習されたboosterを、現在の特徴量列の先頭部分と同じ列で学習されていれば返す（なければNone）
+
+    検証行が一致しないboosterは、今回の検証行を学習済みの可能性があるため返さない。
+    LightGBMの木は列番号で分岐するため、以前の列が同じ順序で先頭に並んでいる場合のみ継続学習できる。
+    """
+    entry = _warm_boosters.get(_fold_hash(valid_idx))
+    if entry is None:
+        return None
+    prev_features, booster = entry
+    features = tuple(features)
+    return booster if features[:len(prev_features)] == prev_features else None
+
+
+def _load_fast_ops():
+    """core.fast_ops を読み込む
+
+    Numbaのディスクキャッシュはimport時のモジュール名を記録するため、どこから読み込んでも
+    同じ名前になるよう `core.fast_ops` としてimportする。numpy / numba がない場合以外の失敗は表示する。
+    """
+    global _fast_ops
+    if _REPO_ROOT not in sys.path:
+        sys.path.insert(0, _REPO_ROOT)
+    try:
+        from core import fast_ops
+    except ModuleNotFoundError as e:
+        if e.name not in ("numpy", "numba"):
+            traceback.print_exc()
+        return
+    except Exception:
+        traceback.print_exc()
+        return
+    _fast_ops = fast_ops
+
+
+def _session_globals(code: str) -> dict:
+    """実行ごとのglobalsに渡すデータ（スクリプトが破壊的に変更しても読み込み済みのデータは変わらない）
+
+    コピーのコストを避けるため、train_df / test_df はコード中でその名前を参照している場合だけ渡す。
+    """
+    helpers = {
+        "get_warm_booster": get_warm_booster,
+        "save_warm_booster": save_warm_booster,
+    }
+    if _fast_ops is not None:
+        helpers["fast_ops"] = _fast_ops
+    if not _session:
+        return helpers
+    exec_globals = {"folds": _session["folds"], **helpers}
+    for name in ("train_df", "test_df"):
+        if name in code:
+            df = _session[name]
+            exec_globals[name] = _session_copy(df) if df is not None else None
+    return exec_globals
+
+
+def _run_code(code: str, filename: str, max_lines: int) -> dict:
+    """新しいglobalsでコードを実行し、結果を辞書で返す"""
+    stdout = OutputCollector(max_lines, parse_json=True)
+    stderr = OutputCollector(max_lines)
+    # トレースバックにソース行が出るよう登録しておく
+    linecache.cache[filename] = (len(code), None, code.splitlines(True), filename)
+    exec_globals = {"__name__": "__main__", "__file__": filename, "__builtins__": __builtins__}
+    exec_globals.update(_session_globals(code))
+    cwd = os.getcwd()
+    argv = sys.argv
+
+    success = True
+    error_type = None
+    error_message = None
+    with contextlib.redirect_stdout(stdout), contextlib.redirect_stderr(stderr):
+        sys.argv = [filename]
+        try:
+            exec(compile(code, filename, "exec"), exec_globals)
+        except SystemExit as e:
+            if e.code not in (None, 0):
+                success = False
+                error_type = "SystemExit"
+                error_message = f"Script exited with code {e.code}"
+        except BaseException as e:
+            success = False
+            error_type = type(e).__name__
+            error_message = str(e)
+            traceback.print_exc()
+        finally:
+            sys.argv = argv
+            os.chdir(cwd)
+
+    exec_globals.clear()
+    linecache.cache.pop(filename, None)
+    gc.collect()
+
+    return {
+        "success": success,
+        "stdout": stdout.getvalue(),
+        "stderr": stderr.getvalue(),
+        "return_value": stdout.last_json,
+        "error_type": error_type,
+        "error_message": error_message,
+    }
+
+
+def main():
+    # stdoutはプロトコル専用にし、fdレベルの出力（C拡張のログ等）はstderrへ流す
+    protocol_out = os.fdopen(os.dup(sys.stdout.fileno()), "wb")
+    os.dup2(sys.stderr.fileno(), sys.stdout.fileno())
+    protocol_in = sys.stdin.buffer
+
+    # 並列実行時は割り当てられたCPUに固定する（スレッドプールのサイズが決まるimport前に行う）
+    cpus = os.environ.get(CPU_AFFINITY_ENV)
+    if cpus and hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, {int(c) for c in cpus.split(",")})
+
+    for name in PRELOAD_MODULES:
+        try:
+            importlib.import_module(name)
+        except ImportError:
+            pass
+    _install_read_csv_patch()
+
+    _load_fast_ops()
+
+    send_message(protocol_out, {"ready": True, "fast_ops": _fast_ops is not None})
+
+    while True:
+        message = recv_message(protocol_in)
+        if message is None:
+            break
+        op = message.get("op")
+        if op == "exec":
+            response = _run_code(
+                message["code"],
+                message.get("filename", "<agent_script>"),
+                message.get("max_output_lines", 512),
+            )
+        elif op == "ping":
+            response = {"success": True, "stdout": "", "stderr": ""}
+        elif op == "load_dataset":
+            try:
+                response = _load_dataset(**message["dataset"])
+            except Exception as e:
+                response = {
+                    "success": False,
+                    "stdout": "",
+                    "stderr": traceback.format_exc(),
+                    "error_type": type(e).__name__,
+                    "error_message": str(e),
+                }
+        else:
+            response = {
+                "success": False,
+                "stdout": "",
+                "stderr": "",
+                "error_type": "ValueError",
+                "error_message": f"Unknown op: {op}",
+            }
+        send_message(protocol_out, response)
+
+
+if __name__ == "__main__":
+    main()
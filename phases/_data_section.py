@@ -0,0 +1,27 @@
+"""Prompt section telling generated scripts where train/test data come from"""
+
+
+PRELOADED_DATA_SECTION = """## Preloaded Data:
+`train_df`, `test_df` (raw train.csv / test.csv as pandas DataFrames) and `folds` (list of (train_idx, valid_idx)) already exist as globals.
+Do not call read_csv for train.csv or test.csv."""
+
+
+READ_DATA_SECTION = """## Data Loading:
+Load train.csv / test.csv (or the train/test files in the data directory) into `train_df` / `test_df` with pandas."""
+
+
+# Without preloaded folds, scripts that must agree on the CV split build the same one themselves
+READ_FOLDS_SENTENCE = """Build `folds = list(splitter.split(train_df, train_df[target_column]))` with StratifiedKFold for classification
+(KFold otherwise), n_splits=5, shuffle=True, random_state=42, so every model uses the same folds."""
+
+
+def data_section(preloaded: bool, shared_folds: bool = False) -> str:
+    """Return the Preloaded Data section if the executor loaded the dataset, otherwise loading instructions.
+
+    `shared_folds` adds how to rebuild the common `folds` when they are not preloaded.
+    """
+    if preloaded:
+        return PRELOADED_DATA_SECTION
+    if shared_folds:
+        return f"{READ_DATA_SECTION}\n{READ_FOLDS_SENTENCE}"
+    return READ_DATA_SECTION
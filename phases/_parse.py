@@ -0,0 +1,45 @@
+"""Parse the JSON result line printed by generated scripts"""
+
+import json
+import re
+
+try:
+    from orjson import loads as _orjson_loads
+except ImportError:
+    _orjson_loads = None
+
+
+# Flat JSON objects carrying one of the result keys the prompts ask for
+_JSON_RE = re.compile(r'\{[^{}]*"(?:new_features|cv_score|model_type)"[^{}]*\}')
+
+
+def json_loads(text: str):
+    """Parse with orjson when available, retrying with json.loads for NaN/Infinity (which orjson rejects)."""
+    if _orjson_loads is not None:
+        try:
+            return _orjson_loads(text)
+        except ValueError:
+            pass
+    return json.loads(text)
+
+
+def parse_json_output(stdout: str, default: dict) -> dict:
+    """Return the last result object printed to stdout, or a copy of `default`."""
+    for match in reversed(_JSON_RE.findall(stdout)):
+        try:
+            return json_loads(match)
+        except ValueError:
+            continue
+
+    # Nested objects are missed by the regex; fall back to parsing whole lines
+    for line in reversed(stdout.splitlines()):
+        line = line.strip()
+        if not line.startswith("{"):
+            continue
+        try:
+            value = json_loads(line)
+        except ValueError:
+            continue
+        if isinstance(value, dict):
+            return value
+    return dict(default)
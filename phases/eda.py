@@ -1,7 +1,8 @@
 """EDA Phase - Exploratory Data Analysis"""
 
 from typing import TYPE_CHECKING
-import json
+
+from ._data_section import data_section
 
 if TYPE_CHECKING:
     from core.llm import LLMManager
@@ -18,8 +19,10 @@ EDA_CODE_PROMPT = """You are a data scientist. Generate Python code for EDA base
 - Data directory: {data_dir}
 - Files: {available_files}
 
+{data_section}
+
 ## Requirements:
-1. Load train.csv
+1. Use `train_df` as described above
 2. Calculate basic statistics
 3. Check missing values
 4. Check target distribution
@@ -51,19 +54,24 @@ class EDAPhase:
         self.memory = memory
     
     def run(self, context: dict) -> dict:
+        load_result = self.executor.load_dataset(context)
+        if not load_result.success:
+            print(f"  Warning: Could not preload dataset: {load_result.error_message}")
+        
         prompt = EDA_CODE_PROMPT.format(
             task_type=context.get("task_type", "unknown"),
             metric=context.get("metric", "unknown"),
             target_column=context.get("target_column", "target"),
             data_dir=context.get("data_dir", "."),
-            available_files=context.get("available_files", [])
+            available_files=context.get("available_files", []),
+            data_section=data_section(self.executor.dataset_loaded)
         )
         
-        code = self.llm.generate_code(prompt)
+        code = self.llm.generate_code_cached(prompt, cache_key="eda")
         result = self.executor.execute_with_retry(code, self.llm)
         
         if result.success:
-            insights = self._parse_eda_output(result.stdout)
+            insights = result.return_value or self._default_insights()
             
             self.memory.add_experiment(
                 phase="eda",
@@ -84,15 +92,6 @@ class EDAPhase:
             )
             return self._default_insights()
     
-    def _parse_eda_output(self, stdout: str) -> dict:
-        lines = stdout.strip().split("\n")
-        for line in reversed(lines):
-            try:
-                return json.loads(line)
-            except json.JSONDecodeError:
-                continue
-        return self._default_insights()
-    
     def _default_insights(self) -> dict:
         return {
             "num_samples": 0,
@@ -1,7 +1,8 @@
 """Ensemble Phase - Ensemble learning"""
 
 from typing import TYPE_CHECKING
-import json
+
+from ._data_section import data_section
 
 if TYPE_CHECKING:
     from core.llm import LLMManager
@@ -9,6 +10,42 @@ if TYPE_CHECKING:
     from core.memory import AgentMemory, ModelRecord
 
 
+BASE_MODELS = ["lightgbm", "xgboost", "catboost"]
+
+
+BASE_MODEL_PROMPT = """You are a Kaggle Grandmaster. Generate code that trains one base model for an ensemble.
+
+## Competition Info:
+- Task: {task_type}
+- Metric: {metric}
+- Target column: {target_column}
+- Data directory: {data_dir}
+
+## Base Model:
+{model_name}
+
+{data_section}
+If train_fe.csv / test_fe.csv exist, load those for the engineered features and reuse `folds`.
+
+## Requirements:
+1. Train {model_name} with `folds` as described above
+2. Save out-of-fold predictions (aligned with train rows) with np.save("oof_{model_name}.npy", oof)
+3. Save test predictions (averaged over folds) with np.save("test_{model_name}.npy", test_pred)
+4. Calculate CV score from the out-of-fold predictions
+5. Do not write submission.csv
+
+## Output Format:
+```
+print(json.dumps({{
+    "cv_score": cv_score,
+    "model_type": "{model_name}"
+}}))
+```
+
+Generate only the code without explanations.
+"""
+
+
 ENSEMBLE_PROMPT = """You are a Kaggle Grandmaster. Generate ensemble code.
 
 ## Competition Info:
@@ -20,11 +57,17 @@ ENSEMBLE_PROMPT = """You are a Kaggle Grandmaster. Generate ensemble code.
 ## Available Models:
 {available_models}
 
+## Base Model Predictions:
+{base_models}
+For each name, out-of-fold predictions are saved as oof_<name>.npy and test predictions as test_<name>.npy.
+
 ## Ensemble Strategy:
 {ensemble_strategy}
 
+{data_section}
+
 ## Requirements:
-1. Train multiple models (LightGBM, XGBoost, CatBoost)
+1. Load the saved base model predictions (do not retrain the base models)
 2. Apply ensemble ({ensemble_type})
 3. Calculate CV score
 4. Save predictions as submission.csv
@@ -52,12 +95,14 @@ class EnsemblePhase:
     
     def run(self, best_models: list["ModelRecord"]) -> dict:
         context = self.memory.competition_context
-        eda = self.memory.eda_insights
         
-        if len(best_models) >= 3:
+        # Base learners are independent: train them in parallel worker processes
+        trained = self._train_base_models(context)
+        
+        if len(trained) >= 3:
             ensemble_type = "stacking"
             strategy = "3+ models available, use stacking"
-        elif len(best_models) >= 2:
+        elif len(trained) >= 2:
             ensemble_type = "blending"
             strategy = "2 models, use weighted averaging with optimization"
         else:
@@ -69,21 +114,27 @@ class EnsemblePhase:
             for m in best_models
         ]) if best_models else "No models"
         
+        base_info = "\n".join([
+            f"- {name}: CV={score:.5f}" for name, score in trained.items()
+        ]) if trained else "No base model predictions"
+        
         prompt = ENSEMBLE_PROMPT.format(
             task_type=context.get("task_type", "classification"),
             metric=context.get("metric", "auc"),
             target_column=context.get("target_column", "target"),
             data_dir=context.get("data_dir", "."),
             available_models=models_info,
+            base_models=base_info,
             ensemble_strategy=strategy,
-            ensemble_type=ensemble_type
+            ensemble_type=ensemble_type,
+            data_section=self._data_section()
         )
         
-        code = self.llm.generate_code(prompt)
+        code = self.llm.generate_code_cached(prompt, cache_key="ensemble")
         result = self.executor.execute_with_retry(code, self.llm)
         
         if result.success:
-            ensemble_result = self._parse_output(result.stdout)
+            ensemble_result = result.return_value or {"cv_score": 0, "ensemble_type": "unknown"}
             
             self.memory.add_experiment(
                 phase="ensemble",
@@ -103,11 +154,42 @@ class EnsemblePhase:
             best_score = best_models[0].cv_score if best_models else 0
             return {"cv_score": best_score, "ensemble_type": "failed"}
     
-    def _parse_output(self, stdout: str) -> dict:
-        lines = stdout.strip().split("\n")
-        for line in reversed(lines):
-            try:
-                return json.loads(line)
-            except json.JSONDecodeError:
-                continue
-        return {"cv_score": 0, "ensemble_type": "unknown"}
+    def _data_section(self) -> str:
+        # Base models and the ensemble must agree on the CV split
+        return data_section(self.executor.dataset_loaded, shared_folds=True)
+    
+    def _train_base_models(self, context: dict) -> dict[str, float]:
+        """Train each base model in its own worker process and return {name: cv_score} of the successful ones."""
+        codes = {
+            name: self.llm.generate_code_cached(BASE_MODEL_PROMPT.format(
+                task_type=context.get("task_type", "classification"),
+                metric=context.get("metric", "auc"),
+                target_column=context.get("target_column", "target"),
+                data_dir=context.get("data_dir", "."),
+                model_name=name,
+                data_section=self._data_section()
+            ), cache_key="ensemble_base")
+            for name in BASE_MODELS
+        }
+        results = self.executor.execute_parallel(codes)
+        
+        trained = {}
+        for name, code in codes.items():
+            result = results[name]
+            if not result.success:
+                # Fix failures one by one on the main worker
+                result = self.executor.execute_with_retry(code, self.llm, initial_result=result)
+            
+            cv_score = (result.return_value or {}).get("cv_score", 0) if result.success else None
+            self.memory.add_experiment(
+                phase="ensemble",
+                description=f"Base model ({name})" if result.success else f"Base model ({name}, failed)",
+                code=code,
+                cv_score=cv_score,
+                success=result.success,
+                model_type=name
+            )
+            if result.success:
+                trained[name] = cv_score
+        
+        return trained
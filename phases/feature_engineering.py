@@ -1,7 +1,11 @@
 """Feature Engineering Phase - Generate new features"""
 
-from typing import TYPE_CHECKING
-import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
+import os
+import threading
+
+from ._parse import parse_json_output
 
 if TYPE_CHECKING:
     from core.llm import LLMManager
@@ -9,10 +13,50 @@ if TYPE_CHECKING:
     from core.memory import AgentMemory
 
 
-FE_CODE_PROMPT = """You are a Kaggle Grandmaster. Generate Python code for feature engineering based on the following info.
+# Static instructions, sent first so the LLM server reuses their KV cache across calls
+FE_CODE_PROMPT_PREFIX = """You are a Kaggle Grandmaster. Generate Python code that adds a single feature idea, given after these instructions, and measures its effect.
+
+## Requirements:
+1. Load train_fe.csv and test_fe.csv if they exist, otherwise train.csv and test.csv
+2. Implement only the given feature idea (1-3 new columns)
+3. Measure its effect with a quick LightGBM CV (about 200 rounds) on the global `folds` (list of (train_idx, valid_idx)) if it is predefined, otherwise on KFold(n_splits=5, shuffle=True, random_state=42), once without and once with the new columns
+4. Save train with the new columns as train_fe_candidate.csv, and test with the same transformations as test_fe_candidate.csv
+5. Output results in JSON format. `cv_impact` must be positive when the new columns improve the metric (for lower-is-better metrics use score_without - score_with)
+
+## Output Format:
+```
+print(json.dumps({
+    "new_features": ["feature_name1", "feature_name2"],
+    "cv_impact": cv_impact,
+    "description": "what was done"
+}))
+```"""
+
+
+# Appended to the prefix only when the executor worker managed to load core/fast_ops.py
+FAST_OPS_SECTION = """## Fast Helpers:
+A Numba-compiled module `fast_ops` is predefined (do not import it). Use it instead of Python row loops.
+Keys must be integer codes from `pd.factorize(col)[0]` with `n_groups = keys.max() + 1` (keys must be < n_groups or a ValueError is raised).
+- `fast_ops.target_encode(keys, target, n_groups, smoothing=10.0, folds=None)` -> per-row encoding (out-of-fold when `folds` is given)
+- `fast_ops.target_encode_map(keys, target, n_groups, smoothing=10.0)` -> per-group values; for test rows use `mapping[test_keys]`
+- `fast_ops.groupby_mean(keys, values, n_groups)` -> per-group mean
+- `fast_ops.count_encode(keys, n_groups)` -> per-row count of each key
+Factorize train and test together so keys share the same codes."""
 
-## Competition Info:
+
+def _render_fe_single_prompt(
+    task_type: str,
+    metric: str,
+    target_column: str,
+    data_dir: str,
+    numeric_columns: list,
+    categorical_columns: list,
+    experiment_history: str,
+    feature_idea: str,
+) -> str:
+    return f"""## Competition Info:
 - Task: {task_type}
+- Metric: {metric}
 - Target column: {target_column}
 - Data directory: {data_dir}
 
@@ -23,28 +67,17 @@ FE_CODE_PROMPT = """You are a Kaggle Grandmaster. Generate Python code for featu
 ## Previous Experiments:
 {experiment_history}
 
-## Features to Generate (pick 1-3):
-{feature_ideas}
-
-## Requirements:
-1. Load train.csv (or train_fe.csv if exists)
-2. Generate new features
-3. Save as train_fe.csv
-4. Apply the same transformations to test.csv and save as test_fe.csv
-5. Output results in JSON format
-
-## Output Format:
-```
-print(json.dumps({{
-    "new_features": ["feature_name1", "feature_name2"],
-    "description": "what was done"
-}}))
-```
+## Feature Idea:
+{feature_idea}
 
 Generate only the code without explanations.
 """
 
 
+# Ideas tried per iteration; each one gets its own prompt and candidate run
+MAX_IDEAS_PER_ITERATION = 5
+
+
 class FeatureEngineeringPhase:
     """Feature Engineering Phase"""
     
@@ -53,47 +86,116 @@ class FeatureEngineeringPhase:
         self.executor = executor
         self.memory = memory
     
-    def run(self, eda_insights: dict, history: list[dict]) -> dict:
+    def generate(
+        self,
+        eda_insights: dict,
+        cancel: Optional[threading.Event] = None
+    ) -> list[tuple[str, str]]:
+        """Generate one FE script per untried idea without executing them (can run ahead of `run`).
+        
+        Once `cancel` is set, ideas whose LLM call has not started yet are skipped.
+        Ideas whose LLM call fails are left out of the result.
+        """
         context = self.memory.competition_context
         
         untried = self.memory.get_untried_features()
         if not untried:
             untried = self._generate_feature_ideas(eda_insights)
+        ideas = untried[:MAX_IDEAS_PER_ITERATION]
+        experiment_history = self.memory.history_summary_str
+        prefix = FE_CODE_PROMPT_PREFIX
+        if self.executor.fast_ops_loaded:
+            prefix = f"{prefix}\n\n{FAST_OPS_SECTION}"
         
-        prompt = FE_CODE_PROMPT.format(
-            task_type=context.get("task_type", "unknown"),
-            target_column=context.get("target_column", "target"),
-            data_dir=context.get("data_dir", "."),
-            numeric_columns=eda_insights.get("numeric_columns", []),
-            categorical_columns=eda_insights.get("categorical_columns", []),
-            experiment_history=self._format_history(history),
-            feature_ideas="\n".join(f"- {idea}" for idea in untried[:5])
-        )
+        def _generate(idea: str) -> Optional[str]:
+            if cancel is not None and cancel.is_set():
+                return None
+            prompt = _render_fe_single_prompt(
+                task_type=context.get("task_type", "unknown"),
+                metric=context.get("metric", "unknown"),
+                target_column=context.get("target_column", "target"),
+                data_dir=context.get("data_dir", "."),
+                numeric_columns=eda_insights.get("numeric_columns", []),
+                categorical_columns=eda_insights.get("categorical_columns", []),
+                experiment_history=experiment_history,
+                feature_idea=idea
+            )
+            try:
+                return self.llm.generate_code_cached(
+                    prompt, cache_key="feature_engineering", prefix=prefix
+                )
+            except Exception as e:
+                # Drop only this idea; it stays untried and can be retried in a later iteration
+                print(f"  Warning: Could not generate FE code for '{idea}': {e}")
+                return None
         
-        code = self.llm.generate_code(prompt)
-        result = self.executor.execute_with_retry(code, self.llm)
+        if not ideas:
+            return []
+        # The local server handles max_parallel_requests at a time; more threads would only queue
+        # after the cancel check, so `cancel` could no longer skip them
+        with ThreadPoolExecutor(max_workers=min(len(ideas), self.llm.max_parallel_requests)) as pool:
+            codes = list(pool.map(_generate, ideas))
+        return [(idea, code) for idea, code in zip(ideas, codes) if code is not None]
+    
+    def run(
+        self,
+        eda_insights: dict,
+        generated: Optional[list[tuple[str, str]]] = None
+    ) -> dict:
+        """Run the candidates one by one and keep the features that improve CV."""
+        if generated is None:
+            generated = self.generate(eda_insights)
         
-        if result.success:
-            fe_result = self._parse_output(result.stdout)
+        new_features = []
+        descriptions = []
+        for idea, code in generated:
+            # Candidates build on train_fe.csv, so they run sequentially on the main worker
+            self._remove_candidate_files()
+            result = self.executor.execute_with_retry(code, self.llm)
             
-            for idea in untried[:3]:
-                self.memory.mark_feature_tried(idea)
+            if not result.success:
+                self.memory.add_experiment(
+                    phase="feature_engineering",
+                    description=f"FE: {idea} (failed)",
+                    code=code,
+                    success=False
+                )
+                continue
             
+            fe_result = self._parse_output(result.stdout)
+            cv_impact = fe_result.get("cv_impact") or 0
+            self.memory.mark_feature_tried(idea)
+            
+            kept = cv_impact > 0 and self._promote_candidate()
             self.memory.add_experiment(
                 phase="feature_engineering",
-                description=fe_result.get("description", "FE"),
-                code=code,
-                success=True
-            )
-            return fe_result
-        else:
-            self.memory.add_experiment(
-                phase="feature_engineering",
-                description="FE (failed)",
+                description=fe_result.get("description", f"FE: {idea}"),
                 code=code,
-                success=False
+                success=True,
+                notes=f"cv_impact={cv_impact}" + ("" if kept else " (discarded)")
             )
-            return {"new_features": [], "description": "Failed"}
+            if kept:
+                new_features.extend(fe_result.get("new_features", []))
+                descriptions.append(fe_result.get("description", idea))
+        
+        self._remove_candidate_files()
+        if not descriptions:
+            return {"new_features": [], "description": "No feature improved CV"}
+        return {"new_features": new_features, "description": "; ".join(descriptions)}
+    
+    def _promote_candidate(self) -> bool:
+        """Replace train_fe.csv/test_fe.csv with the candidate's outputs."""
+        working_dir = self.executor.working_dir
+        candidates = [working_dir / f"{split}_fe_candidate.csv" for split in ("train", "test")]
+        if not all(path.exists() for path in candidates):
+            return False
+        for split, path in zip(("train", "test"), candidates):
+            os.replace(path, working_dir / f"{split}_fe.csv")
+        return True
+    
+    def _remove_candidate_files(self):
+        for split in ("train", "test"):
+            (self.executor.working_dir / f"{split}_fe_candidate.csv").unlink(missing_ok=True)
     
     def _generate_feature_ideas(self, eda_insights: dict) -> list[str]:
         ideas = []
@@ -110,18 +212,8 @@ class FeatureEngineeringPhase:
         for idea in ideas:
             self.memory.add_feature_idea(idea)
         
-        return ideas
-    
-    def _format_history(self, history: list[dict]) -> str:
-        if not history:
-            return "No previous experiments."
-        return "\n".join([f"- {exp.get('description', 'N/A')}" for exp in history[-5:]])
+        # Ideas that were already tried are skipped by add_feature_idea
+        return self.memory.get_untried_features()
     
     def _parse_output(self, stdout: str) -> dict:
-        lines = stdout.strip().split("\n")
-        for line in reversed(lines):
-            try:
-                return json.loads(line)
-            except json.JSONDecodeError:
-                continue
-        return {"new_features": [], "description": "Unknown"}
+        return parse_json_output(stdout, {"new_features": [], "description": "Unknown"})
@@ -1,8 +1,10 @@
 """Modeling Phase - Model training and evaluation"""
 
-from typing import TYPE_CHECKING
-from core.memory import ModelRecord
-import json
+from concurrent.futures import ThreadPoolExecutor
+from typing import TYPE_CHECKING, Optional
+import os
+
+from ._parse import parse_json_output
 
 if TYPE_CHECKING:
     from core.llm import LLMManager
@@ -10,17 +12,8 @@ if TYPE_CHECKING:
     from core.memory import AgentMemory
 
 
-BASELINE_PROMPT = """You are a Kaggle Grandmaster. Generate Python code for a baseline model.
-
-## Competition Info:
-- Task: {task_type}
-- Metric: {metric}
-- Target column: {target_column}
-- Data directory: {data_dir}
-
-## EDA Results:
-- Numeric columns: {numeric_columns}
-- Categorical columns: {categorical_columns}
+# Static instructions, sent first so the LLM server reuses their KV cache across calls
+BASELINE_PROMPT_PREFIX = """You are a Kaggle Grandmaster. Generate Python code for a baseline model based on the info given after these instructions.
 
 ## Requirements:
 1. Load train.csv (or train_fe.csv if exists)
@@ -30,20 +23,80 @@ BASELINE_PROMPT = """You are a Kaggle Grandmaster. Generate Python code for a ba
 
 ## Output Format:
 ```
-print(json.dumps({{
+print(json.dumps({
     "cv_score": cv_score,
     "fold_scores": [score1, score2, score3, score4, score5],
     "model_type": "lightgbm"
-}}))
-```
+}))
+```"""
+
+
+def _render_baseline_prompt(
+    task_type: str,
+    metric: str,
+    target_column: str,
+    data_dir: str,
+    numeric_columns: list,
+    categorical_columns: list,
+) -> str:
+    return f"""## Competition Info:
+- Task: {task_type}
+- Metric: {metric}
+- Target column: {target_column}
+- Data directory: {data_dir}
+
+## EDA Results:
+- Numeric columns: {numeric_columns}
+- Categorical columns: {categorical_columns}
 
 Generate only the code without explanations.
 """
 
 
-IMPROVE_PROMPT = """You are a Kaggle Grandmaster. Improve the model based on the following info.
+WARM_START_SECTION = """## Warm Start (ALLOW_WARM_START=True):
+The previous model succeeded and the current features are a superset of its features.
+If you use LightGBM, continue training instead of refitting from scratch.
+Use the predefined `folds` (list of (train_idx, valid_idx)) so the validation rows match the previous run. For each fold:
+```
+prev = get_warm_booster(feature_cols, valid_idx)  # predefined, returns None if unavailable
+params["predict_disable_shape_check"] = True
+booster = lgb.train(params, train_set, num_boost_round=..., valid_sets=[valid_set],
+                    init_model=prev, keep_training_booster=True)
+```
+Keep the previous feature columns first and in the same order, and append new features at the end.
+Use fewer boosting rounds than a full refit."""
+
+
+IMPROVE_PROMPT_PREFIX = """You are a Kaggle Grandmaster. Improve the model based on the info given after these instructions.
+
+## Requirements:
+1. Load train_fe.csv (or train.csv)
+2. Apply the improvement focus given below (feature selection by importance or a different CV strategy such as StratifiedKFold/GroupKFold may also help)
+3. Train with 5-fold CV
+4. Save predictions to the submission file given below (not submission.csv)
+5. For LightGBM, call `save_warm_booster(feature_cols, booster, valid_idx)` after training each fold, passing that fold's validation row indices (the function is predefined)
+
+## Output Format:
+```
+print(json.dumps({
+    "cv_score": cv_score,
+    "model_type": "model_name",
+    "improvement": "what was improved"
+}))
+```"""
+
 
-## Competition Info:
+def _render_improve_prompt(
+    task_type: str,
+    metric: str,
+    best_score: float,
+    new_features: list,
+    experiment_history: str,
+    improvement_idea: str,
+    submission_file: str,
+    warm_start: str,
+) -> str:
+    return f"""## Competition Info:
 - Task: {task_type}
 - Metric: {metric}
 - Current best score: {best_score}
@@ -54,31 +107,27 @@ IMPROVE_PROMPT = """You are a Kaggle Grandmaster. Improve the model based on the
 ## Previous Experiments:
 {experiment_history}
 
-## Improvement Ideas:
-- Hyperparameter tuning (learning_rate, num_leaves, etc.)
-- Try XGBoost or CatBoost
-- Feature selection based on importance
-- Different CV strategy (StratifiedKFold, GroupKFold)
+## Improvement Focus:
+{improvement_idea}
 
-## Requirements:
-1. Load train_fe.csv (or train.csv)
-2. Apply improvements
-3. Train with 5-fold CV
-4. Save predictions as submission.csv
+## Submission File:
+{submission_file}
 
-## Output Format:
-```
-print(json.dumps({{
-    "cv_score": cv_score,
-    "model_type": "model_name",
-    "improvement": "what was improved"
-}}))
-```
+{warm_start}
 
 Generate only the code without explanations.
 """
 
 
+# Candidates trained side by side in each improvement step (name -> focus).
+# The first one runs on the main worker so it can warm start from earlier LightGBM boosters.
+IMPROVEMENT_IDEAS = {
+    "lgb_tuned": "Tune LightGBM hyperparameters (learning_rate, num_leaves, min_child_samples, regularization)",
+    "xgboost": "Train XGBoost instead of LightGBM",
+    "catboost": "Train CatBoost instead of LightGBM, passing categorical columns natively",
+}
+
+
 class ModelingPhase:
     """Modeling Phase"""
     
@@ -86,11 +135,15 @@ class ModelingPhase:
         self.llm = llm
         self.executor = executor
         self.memory = memory
+        # Whether the last model trained on the main worker (baseline or primary candidate) succeeded
+        self._main_worker_succeeded = False
     
     def create_baseline(self, eda_insights: dict) -> dict:
+        from core.memory import ModelRecord
+        
         context = self.memory.competition_context
         
-        prompt = BASELINE_PROMPT.format(
+        prompt = _render_baseline_prompt(
             task_type=context.get("task_type", "classification"),
             metric=context.get("metric", "auc"),
             target_column=context.get("target_column", "target"),
@@ -99,8 +152,11 @@ class ModelingPhase:
             categorical_columns=eda_insights.get("categorical_columns", [])
         )
         
-        code = self.llm.generate_code(prompt)
+        code = self.llm.generate_code_cached(
+            prompt, cache_key="baseline", prefix=BASELINE_PROMPT_PREFIX
+        )
         result = self.executor.execute_with_retry(code, self.llm)
+        self._main_worker_succeeded = result.success
         
         if result.success:
             model_result = self._parse_output(result.stdout)
@@ -130,54 +186,109 @@ class ModelingPhase:
             )
             return {"cv_score": 0, "model_type": "failed"}
     
-    def improve(self, fe_result: dict) -> dict:
+    def improve(self, fe_result: dict, improvement_ideas: Optional[dict[str, str]] = None) -> dict:
+        """Train one candidate per improvement idea in parallel and keep the best one."""
+        from core.memory import ModelRecord
+        
         context = self.memory.competition_context
+        ideas = improvement_ideas or IMPROVEMENT_IDEAS
+        names = list(ideas)
+        warm_start = WARM_START_SECTION if self._can_warm_start(fe_result) else ""
+        experiment_history = self.memory.get_history_summary()
+        primary = names[0]
         
-        prompt = IMPROVE_PROMPT.format(
-            task_type=context.get("task_type", "classification"),
-            metric=context.get("metric", "auc"),
-            best_score=self.memory.best_score,
-            new_features=fe_result.get("new_features", []),
-            experiment_history=self.memory.get_history_summary()
-        )
+        def _generate(name: str) -> Optional[str]:
+            prompt = _render_improve_prompt(
+                task_type=context.get("task_type", "classification"),
+                metric=context.get("metric", "auc"),
+                best_score=self.memory.best_score,
+                new_features=fe_result.get("new_features", []),
+                experiment_history=experiment_history,
+                improvement_idea=ideas[name],
+                submission_file=f"submission_{name}.csv",
+                warm_start=warm_start if name == primary else ""
+            )
+            try:
+                return self.llm.generate_code_cached(
+                    prompt, cache_key="improve", prefix=IMPROVE_PROMPT_PREFIX
+                )
+            except Exception as e:
+                print(f"  Warning: Could not generate code for candidate '{name}': {e}")
+                return None
         
-        code = self.llm.generate_code(prompt)
-        result = self.executor.execute_with_retry(code, self.llm)
+        with ThreadPoolExecutor(max_workers=4) as pool:
+            # Candidates whose code generation failed are dropped; the first remaining one takes the main worker
+            codes = {
+                name: code for name, code in zip(names, pool.map(_generate, names))
+                if code is not None
+            }
+            names = list(codes)
+            if not names:
+                return {"cv_score": 0}
+            
+            # The primary candidate keeps the main worker (and its warm boosters);
+            # the others run in their own worker processes at the same time, each on its own CPU slice
+            others = {name: codes[name] for name in names[1:]}
+            others_future = pool.submit(self.executor.execute_parallel, others, reserve_main=True)
+            results = {names[0]: self.executor.execute_with_retry(codes[names[0]], self.llm)}
+            results.update(others_future.result())
+        self._main_worker_succeeded = results[names[0]].success
         
-        if result.success:
-            model_result = self._parse_output(result.stdout)
-            cv_score = model_result.get("cv_score", 0)
+        best_name = None
+        best_result = {"cv_score": 0}
+        for name in names:
+            result = results[name]
+            if not result.success and name != names[0]:
+                result = self.executor.execute_with_retry(codes[name], self.llm, initial_result=result)
             
-            if cv_score > self.memory.best_score:
-                self.memory.add_model(ModelRecord(
-                    name=f"improved_{model_result.get('model_type', 'unknown')}",
-                    model_type=model_result.get("model_type", "unknown"),
-                    cv_score=cv_score
-                ))
+            if not result.success:
+                self.memory.add_experiment(
+                    phase="modeling",
+                    description=f"Improvement ({name}, failed)",
+                    code=codes[name],
+                    success=False
+                )
+                continue
             
+            model_result = self._parse_output(result.stdout)
+            cv_score = model_result.get("cv_score", 0)
             self.memory.add_experiment(
                 phase="modeling",
-                description=model_result.get("improvement", "Improvement"),
-                code=code,
+                description=model_result.get("improvement", f"Improvement ({name})"),
+                code=codes[name],
                 cv_score=cv_score,
                 success=True,
                 model_type=model_result.get("model_type")
             )
-            return model_result
-        else:
-            self.memory.add_experiment(
-                phase="modeling",
-                description="Improvement (failed)",
-                code=code,
-                success=False
-            )
-            return {"cv_score": 0}
+            if best_name is None or cv_score > best_result.get("cv_score", 0):
+                best_name, best_result = name, model_result
+        
+        if best_name is not None and best_result.get("cv_score", 0) > self.memory.best_score:
+            self.memory.add_model(ModelRecord(
+                name=f"improved_{best_result.get('model_type', 'unknown')}",
+                model_type=best_result.get("model_type", "unknown"),
+                cv_score=best_result.get("cv_score", 0)
+            ))
+            self._promote_submission(best_name)
+        self._remove_candidate_submissions(names)
+        
+        return best_result
+    
+    def _promote_submission(self, name: str):
+        candidate = self.executor.working_dir / f"submission_{name}.csv"
+        if candidate.exists():
+            os.replace(candidate, self.executor.working_dir / "submission.csv")
+    
+    def _remove_candidate_submissions(self, names: list[str]):
+        for name in names:
+            (self.executor.working_dir / f"submission_{name}.csv").unlink(missing_ok=True)
+    
+    def _can_warm_start(self, fe_result: dict) -> bool:
+        """Warm start is allowed when the last main-worker model succeeded and FE only added features."""
+        if not self.executor.dataset_loaded:
+            # Boosters are matched by the predefined `folds`, which only exist with a preloaded dataset
+            return False
+        return bool(fe_result.get("new_features")) and self._main_worker_succeeded
     
     def _parse_output(self, stdout: str) -> dict:
-        lines = stdout.strip().split("\n")
-        for line in reversed(lines):
-            try:
-                return json.loads(line)
-            except json.JSONDecodeError:
-                continue
-        return {"cv_score": 0, "model_type": "unknown"}
+        return parse_json_output(stdout, {"cv_score": 0, "model_type": "unknown"})
@@ -1,46 +1,168 @@
 """Understanding Phase - Kaggle APIを使ってコンペ情報を取得"""
 
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import TYPE_CHECKING, Optional
 import json
 import os
+import re
+import shutil
+import threading
+import zipfile
 
 if TYPE_CHECKING:
     from core.llm import LLMManager
     from core.memory import AgentMemory
 
 
+# 評価指標名からタスクタイプを推測する（英字の途中では一致させない: "smape" は "mae" ではない）
+# 既知の接頭辞（MultiLogLoss, MCRMSE, WRMSSE など）はパターンに含める
+_CLASSIFICATION_METRICS = re.compile(
+    r"(?<![a-z])(auc|accuracy|f1|(?:multi(?:class)?)?log[ _]?loss|precision|recall|mcc|kappa)(?![a-z])"
+)
+_REGRESSION_METRICS = re.compile(r"(?<![a-z])((?:mc|w)?rmsse?|mse|mae|s?mape|rmsle|r2)(?![a-z])")
+
+# どちらのパターンにも一致しない指標名は、従来どおりの部分一致で判定する
+_CLASSIFICATION_KEYWORDS = ("auc", "accuracy", "f1", "logloss", "log loss", "precision", "recall", "mcc", "kappa")
+_REGRESSION_KEYWORDS = ("rmse", "mse", "mae", "mape", "rmsle", "r2")
+
+# 優先順に並べた目的変数の候補
+_TARGET_CANDIDATES = ("target", "Target", "label", "Label", "y", "class")
+
+DATA_EXTENSIONS = (".csv", ".parquet", ".feather")
+_READ_BUFFER_SIZE = 1 << 20
+_EXTRACT_BUFFER_SIZE = 8 << 20
+
+# 認証済みのKaggle API（全フェーズ・全スレッドで共有）
+_kaggle_api = None
+_kaggle_api_lock = threading.Lock()
+
+
+def get_kaggle_api():
+    """Kaggle APIを初期化（認証は初回のみ）"""
+    global _kaggle_api
+    with _kaggle_api_lock:
+        if _kaggle_api is None:
+            from kaggle.api.kaggle_api_extended import KaggleApi
+            api = KaggleApi()
+            api.authenticate()
+            _kaggle_api = api
+        return _kaggle_api
+
+
+def _count_rows(path: Path) -> int:
+    """CSVのデータ行数（ヘッダーを除く）を1MBずつ改行を数えて求める
+
+    クォート内の改行も1行として数えるため、そのようなCSVでは概算になる。
+    """
+    lines = 0
+    last = b"\n"
+    with open(path, "rb", buffering=_READ_BUFFER_SIZE) as f:
+        for buf in iter(lambda: f.read(_READ_BUFFER_SIZE), b""):
+            lines += buf.count(b"\n")
+            last = buf[-1:]
+    # 末尾に改行がない最終行も数える
+    if last != b"\n":
+        lines += 1
+    return max(lines - 1, 0)
+
+
+def _read_columns_and_rows(path: Path) -> tuple[list[str], int]:
+    """カラム名と行数を取得（parquet/featherはメタデータのみ読む）"""
+    if path.suffix == ".parquet":
+        import pyarrow.parquet as pq
+        parquet_file = pq.ParquetFile(path)
+        return parquet_file.schema_arrow.names, parquet_file.metadata.num_rows
+    if path.suffix == ".feather":
+        import pyarrow as pa
+        import pyarrow.ipc as ipc
+        # メモリマップなのでバッチのヘッダー以外は読み込まれない
+        with pa.memory_map(str(path)) as source, ipc.open_file(source) as reader:
+            rows = sum(reader.get_batch(i).num_rows for i in range(reader.num_record_batches))
+            return reader.schema.names, rows
+    
+    try:
+        import pyarrow as pa
+        import pyarrow.csv as pa_csv
+    except ImportError:
+        pa = None
+    
+    columns = None
+    if pa is not None:
+        # ストリーミングリーダーはスキーマ推論のため先頭ブロック（1MB）だけを読む
+        read_options = pa_csv.ReadOptions(block_size=_READ_BUFFER_SIZE)
+        try:
+            with pa_csv.open_csv(path, read_options=read_options) as reader:
+                columns = reader.schema.names
+        except pa.ArrowInvalid:
+            # 1行がブロックに収まらないほど横に広いCSVなど
+            pass
+    if columns is None:
+        import pandas as pd
+        columns = list(pd.read_csv(path, nrows=100).columns)
+    return columns, _count_rows(path)
+
+
+def _extract_zip(zip_path: Path, output_dir: Path):
+    """ZIPの各エントリをスレッドごとに開いたZipFileで並列に解凍"""
+    root = output_dir.resolve()
+    local = threading.local()
+    archives = []
+    archives_lock = threading.Lock()
+    
+    def _extract(info: zipfile.ZipInfo):
+        dst = (root / info.filename).resolve()
+        if not dst.is_relative_to(root):
+            raise ValueError(f"Unsafe path in {zip_path.name}: {info.filename}")
+        if info.is_dir():
+            dst.mkdir(parents=True, exist_ok=True)
+            return
+        if not hasattr(local, "archive"):
+            local.archive = zipfile.ZipFile(zip_path)
+            with archives_lock:
+                archives.append(local.archive)
+        dst.parent.mkdir(parents=True, exist_ok=True)
+        with local.archive.open(info) as src, open(dst, "wb") as out:
+            shutil.copyfileobj(src, out, length=_EXTRACT_BUFFER_SIZE)
+    
+    with zipfile.ZipFile(zip_path) as z:
+        infos = z.infolist()
+    try:
+        with ThreadPoolExecutor(max_workers=max(1, min(len(infos), os.cpu_count() or 1))) as pool:
+            list(pool.map(_extract, infos))
+    finally:
+        for archive in archives:
+            archive.close()
+
+
 class UnderstandingPhase:
     """コンペ理解フェーズ（Kaggle API使用）"""
     
     def __init__(self, llm: "LLMManager", memory: "AgentMemory"):
         self.llm = llm
         self.memory = memory
-        self._api = None
-    
-    def _get_kaggle_api(self):
-        """Kaggle APIを初期化"""
-        if self._api is None:
-            from kaggle.api.kaggle_api_extended import KaggleApi
-            self._api = KaggleApi()
-            self._api.authenticate()
-        return self._api
     
     def run(self, competition_dir: Path, competition_name: Optional[str] = None) -> dict:
         """コンペ情報を取得"""
         context = {}
         
-        # Kaggle APIでコンペ情報を取得
-        if competition_name:
-            try:
-                api_info = self._fetch_from_kaggle_api(competition_name)
-                context.update(api_info)
-                print(f"  Fetched competition info from Kaggle API")
-            except Exception as e:
-                print(f"  Warning: Could not fetch from Kaggle API: {e}")
-        
-        # ローカルファイルからも情報を補完
-        local_info = self._analyze_local_data(competition_dir)
+        # Kaggle API（ネットワーク待ち）とローカルデータの分析（ディスク読み込み）を並行して行う
+        with ThreadPoolExecutor(max_workers=2) as pool:
+            api_future = (
+                pool.submit(self._fetch_from_kaggle_api, competition_name)
+                if competition_name else None
+            )
+            local_future = pool.submit(self._analyze_local_data, competition_dir)
+            
+            if api_future is not None:
+                try:
+                    context.update(api_future.result())
+                    print(f"  Fetched competition info from Kaggle API")
+                except Exception as e:
+                    print(f"  Warning: Could not fetch from Kaggle API: {e}")
+            
+            # ローカルファイルからも情報を補完
+            local_info = local_future.result()
         
         # APIで取得できなかった情報をローカルから補完
         for key, value in local_info.items():
@@ -50,11 +172,21 @@ class UnderstandingPhase:
         context["data_dir"] = str(competition_dir)
         context["available_files"] = self._list_data_files(competition_dir)
         
+        # 実行ワーカーが一度だけ読み込むデータセットのパス
+        for split in ("train", "test"):
+            path = competition_dir / f"{split}.csv"
+            context[f"{split}_path"] = str(path.resolve()) if path.exists() else None
+        
         return context
     
     def _fetch_from_kaggle_api(self, competition_name: str) -> dict:
-        """Kaggle APIからコンペ情報を取得"""
-        api = self._get_kaggle_api()
+        """Kaggle APIからコンペ情報を取得（有効期限内ならmemoryのキャッシュを返す）"""
+        cache_key = f"competition:{competition_name}"
+        cached = self.memory.get_api_cache(cache_key)
+        if cached is not None:
+            return cached
+        
+        api = get_kaggle_api()
         
         # コンペ情報を取得
         competitions = api.competitions_list(search=competition_name)
@@ -76,7 +208,7 @@ class UnderstandingPhase:
         metric = comp.evaluationMetric or "unknown"
         task_type = self._infer_task_type(metric)
         
-        return {
+        info = {
             "competition_name": comp.ref,
             "title": comp.title,
             "description": comp.description or "",
@@ -86,28 +218,20 @@ class UnderstandingPhase:
             "category": comp.category or "unknown",
             "reward": comp.reward or "unknown",
         }
+        self.memory.set_api_cache(cache_key, info)
+        return info
     
     def _infer_task_type(self, metric: str) -> str:
         """評価指標からタスクタイプを推測"""
         metric_lower = metric.lower()
-        
-        classification_metrics = [
-            "auc", "accuracy", "f1", "logloss", "log loss", 
-            "precision", "recall", "mcc", "kappa"
-        ]
-        
-        regression_metrics = [
-            "rmse", "mse", "mae", "mape", "rmsle", "r2"
-        ]
-        
-        for m in classification_metrics:
-            if m in metric_lower:
-                return "classification"
-        
-        for m in regression_metrics:
-            if m in metric_lower:
-                return "regression"
-        
+        if _CLASSIFICATION_METRICS.search(metric_lower):
+            return "classification"
+        if _REGRESSION_METRICS.search(metric_lower):
+            return "regression"
+        if any(m in metric_lower for m in _CLASSIFICATION_KEYWORDS):
+            return "classification"
+        if any(m in metric_lower for m in _REGRESSION_KEYWORDS):
+            return "regression"
         return "unknown"
     
     def _analyze_local_data(self, competition_dir: Path) -> dict:
@@ -118,25 +242,22 @@ class UnderstandingPhase:
             "num_features": 0
         }
         
-        # train.csvがあれば分析
-        train_path = competition_dir / "train.csv"
-        if train_path.exists():
+        # train.csv（なければ train.parquet / train.feather）があれば分析
+        train_path = next(
+            (path for path in (competition_dir / f"train{ext}" for ext in DATA_EXTENSIONS)
+             if path.exists()),
+            None
+        )
+        if train_path is not None:
             try:
-                import pandas as pd
-                df = pd.read_csv(train_path, nrows=100)
-                
-                info["num_samples"] = len(pd.read_csv(train_path, usecols=[0]))
-                info["num_features"] = len(df.columns)
-                
-                # 目的変数を推測
-                for col in ["target", "Target", "label", "Label", "y", "class"]:
-                    if col in df.columns:
-                        info["target_column"] = col
-                        break
+                columns, info["num_samples"] = _read_columns_and_rows(train_path)
+                info["num_features"] = len(columns)
                 
-                # 最後のカラムが目的変数の可能性
-                if info["target_column"] is None:
-                    info["target_column"] = df.columns[-1]
+                # 目的変数を推測（候補になければ最後のカラムが目的変数の可能性）
+                column_set = set(columns)
+                info["target_column"] = next(
+                    (col for col in _TARGET_CANDIDATES if col in column_set), columns[-1]
+                )
                     
             except Exception:
                 pass
@@ -145,14 +266,15 @@ class UnderstandingPhase:
     
     def _list_data_files(self, competition_dir: Path) -> list[str]:
         """データファイル一覧を取得"""
-        files = []
-        for ext in ["*.csv", "*.parquet", "*.feather"]:
-            files.extend([f.name for f in competition_dir.glob(ext)])
-        return files
+        with os.scandir(competition_dir) as entries:
+            return sorted(
+                entry.name for entry in entries
+                if os.path.splitext(entry.name)[1] in DATA_EXTENSIONS and entry.is_file()
+            )
     
     def download_competition_data(self, competition_name: str, output_dir: Path) -> Path:
         """コンペデータをダウンロード"""
-        api = self._get_kaggle_api()
+        api = get_kaggle_api()
         
         output_dir = Path(output_dir)
         output_dir.mkdir(parents=True, exist_ok=True)
@@ -161,10 +283,8 @@ class UnderstandingPhase:
         api.competition_download_files(competition_name, path=str(output_dir), quiet=False)
         
         # ZIPファイルを解凍
-        import zipfile
         for zip_file in output_dir.glob("*.zip"):
-            with zipfile.ZipFile(zip_file, 'r') as z:
-                z.extractall(output_dir)
+            _extract_zip(zip_file, output_dir)
             zip_file.unlink()  # ZIPを削除
         
         print(f"  Downloaded to: {output_dir}")